@@ -0,0 +1,397 @@
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+# Controller side scoring for the application_id module.  Every category but
+# paths only needs facts that are already on the controller, so they are
+# scored here with the module's own code.  The module is executed on the host
+# at most once, to check every path of the signatures (probe_paths).  Set scoring: remote to execute the module on the
+# host as usual.
+#
+# With memo_dir, results are memoized on the controller keyed by the fact
+# fingerprint of the host, the signatures, the options and the
+# application_id module.  A host whose facts match an earlier host only has
+# the paths that host needed checked, and reuses its result when the paths
+# match too.  Results are not memoized with explain.
+#
+# With state_dir, the last result of every host is kept on the controller
+# together with the hash of each fact category.  The next run only scores
+# the signatures that reference a category or path that changed since, the
+# other results are carried forward.  The last result is discarded when
+# the options or the application_id module changed.
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+
+from ansible.errors import AnsibleError
+from ansible.plugins.action import ActionBase
+
+try:
+    from ansible.module_utils.common.arg_spec import ArgumentSpecValidator
+except ImportError:
+    # Ansible < 2.11, always score on the host
+    ArgumentSpecValidator = None
+
+_application_id = None
+# hash of the loaded application_id source, saved results scored by another
+# version of the module are not reused
+_application_id_sha1 = None
+
+
+def load_application_id(path):
+    global _application_id, _application_id_sha1
+    if _application_id is None:
+        try:
+            import importlib.util
+            spec = importlib.util.spec_from_file_location('_application_id_module', path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        except ImportError:
+            import imp
+            module = imp.load_source('_application_id_module', path)
+        with open(path, 'rb') as f:
+            _application_id_sha1 = hashlib.sha1(f.read()).hexdigest()
+        _application_id = module
+    return _application_id
+
+
+# options that do not change the scoring result
+UNKEYED_ARGS = ['facts', 'explain', 'scoring', 'memo_dir', 'memo_size', 'state_dir']
+# options that do not change the result of a single signature
+UNKEYED_SIGNATURE_ARGS = UNKEYED_ARGS + ['signatures', 'discovered_apps']
+
+
+def sha1(data):
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class MemoStore(object):
+    # Bounded LRU store of JSON documents in a directory, shared by every
+    # worker process.  Recency is the file modification time, which is
+    # bumped on every hit.
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def get(self, key):
+        path = os.path.join(self.path, key + '.json')
+        try:
+            with open(path) as f:
+                value = json.load(f)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return value
+
+    def put(self, key, value):
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.memo')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(value, f)
+        os.rename(tmp, os.path.join(self.path, key + '.json'))
+        self.evict()
+
+    def evict(self):
+        entries = [e for e in os.listdir(self.path) if e.endswith('.json') and e != 'stats.json']
+        # evict in batches so not every store lists the directory twice
+        if len(entries) <= self.size + max(self.size // 10, 1):
+            return
+        aged = list()
+        for e in entries:
+            try:
+                aged.append((os.stat(os.path.join(self.path, e)).st_mtime, e))
+            except OSError:
+                pass
+        aged.sort()
+        for mtime, e in aged[:len(aged) - self.size]:
+            try:
+                os.remove(os.path.join(self.path, e))
+            except OSError:
+                pass
+
+    def record(self, hit):
+        # updates the shared hit and miss counters and returns them
+        with open(os.path.join(self.path, 'stats.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            path = os.path.join(self.path, 'stats.json')
+            try:
+                with open(path) as f:
+                    stats = json.load(f)
+            except (IOError, OSError, ValueError):
+                stats = dict(hits=0, misses=0)
+            stats['hits' if hit else 'misses'] += 1
+            with open(path, 'w') as f:
+                json.dump(stats, f)
+        stats['hit'] = hit
+        stats['hit_rate'] = round(float(stats['hits']) / (stats['hits'] + stats['misses']), 4)
+        return stats
+
+
+def signature_key(sig):
+    # normalized signatures hold parsed version constraints, hash the
+    # package specs they were parsed from instead
+    packages = [p['spec'] if isinstance(p, dict) else p for p in sig['packages']]
+    return sha1(dict(sig, packages=packages))
+
+
+class RemotePaths(object):
+    # Existence of the paths checked on the host so far during this task,
+    # every path is only checked once whichever stage needs it first.  The
+    # expected paths (those the memo entry and the last result need) are
+    # checked in the same remote call as the signature paths.
+    def __init__(self, action, aid, task_vars, timeout=None, scandir=False):
+        self.action = action
+        self.aid = aid
+        self.task_vars = task_vars
+        self.timeout = timeout
+        self.scandir = scandir
+        self.expected = list()
+        self.results = dict()
+        self.timed_out = list()
+
+    def probe(self, paths):
+        probe = self.action.remote_probe(self.aid, self.task_vars, [p for p in paths if p not in self.results],
+                                         self.timeout, self.scandir)
+        self.results.update(probe.results)
+        self.timed_out.extend(probe.timed_out)
+        return self.probe_for(paths)
+
+    def probe_for(self, paths):
+        # a PathProbe of already checked paths
+        probe = self.aid.PathProbe(paths, self.timeout, self.scandir)
+        probe.results = dict((p, self.results[p]) for p in probe.paths if p in self.results)
+        probe.timed_out = [p for p in self.timed_out if p in probe.results]
+        return probe
+
+    def prober(self, signatures, timeout=None, scandir=False):
+        paths = list()
+        for sig in signatures:
+            paths.extend(sig['paths'])
+        self.probe(paths + self.expected)
+        return self.probe_for(paths)
+
+
+class HostState(object):
+    # The last result of a host: the fact category hashes, the checked
+    # paths and the result of every signature by signature hash
+    def __init__(self, state_dir, host, options):
+        self.path = os.path.join(state_dir, host + '.json')
+        self.options = options
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                record = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if not isinstance(record, dict) or record.get('options') != self.options:
+            # scored with other options, nothing can be carried forward
+            return None
+        return record
+
+    def save(self, fingerprints, paths, signatures):
+        record = dict(options=self.options, fingerprints=fingerprints, paths=paths, signatures=signatures)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.state')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(record, f)
+        os.rename(tmp, self.path)
+
+
+class IncrementalScorer(object):
+    # Scores only the signatures affected by what changed since the host's
+    # last run with scorer, and carries the previous result of the others
+    # forward.  A signature is affected when it is new or changed, when it
+    # references a fact category whose hash changed, or when one of its
+    # paths was checked last run and its existence changed.  The paths of
+    # last run are checked by the scorer's prober, with the paths of the
+    # signatures it scores.
+    def __init__(self, aid, scorer, paths, record, fingerprints):
+        self.aid = aid
+        self.scorer = scorer
+        self.paths = paths
+        self.record = record
+        self.fingerprints = fingerprints
+        self.explain = scorer.explain
+        self.path_probe = aid.PathProbe([])
+        self.results = dict()
+        self.stats = None
+
+        self.changed_categories = list()
+        self.changed_paths = list()
+        if record is not None:
+            self.changed_categories = sorted(c for c in fingerprints if fingerprints[c] != record['fingerprints'].get(c))
+
+    def check_paths(self):
+        # the paths checked last run whose existence changed
+        if self.record is not None:
+            probe = self.paths.probe(self.record['paths'])
+            self.changed_paths = sorted(p for p in self.record['paths']
+                                        if probe.results.get(p) != self.record['paths'][p])
+
+    def affected(self, sig, previous, changed_paths):
+        if previous is None:
+            return True
+        for category, fact_category in self.aid.FACT_CATEGORIES.items():
+            if sig[category] and fact_category in self.changed_categories:
+                return True
+        return any(p in changed_paths for p in sig['paths'])
+
+    def rescored(self, signatures):
+        # number of signatures whose previous result can not be carried
+        previous = self.record['signatures'] if self.record is not None else dict()
+        changed_paths = set(self.changed_paths)
+        return len([sig for sig in signatures if self.affected(sig, previous.get(signature_key(sig)), changed_paths)])
+
+    def score(self, signatures):
+        previous = self.record['signatures'] if self.record is not None else dict()
+        keys = [signature_key(sig) for sig in signatures]
+        # Every signature a path change could affect is scored, the paths of
+        # last run are only known once the scorer checked them together with
+        # the paths of the signatures
+        record_paths = self.record['paths'] if self.record is not None else dict()
+        candidates = [i for i, sig in enumerate(signatures) if self.affected(sig, previous.get(keys[i]), record_paths)]
+        scored = self.scorer.score([signatures[i] for i in candidates], signatures)
+        self.check_paths()
+        changed_paths = set(self.changed_paths)
+        rescore = set(i for i in candidates if self.affected(signatures[i], previous.get(keys[i]), changed_paths))
+        results = [previous.get(key) for key in keys]
+        for i, r in zip(candidates, scored):
+            if i in rescore:
+                results[i] = r
+
+        # every path checked for a carried or rescored signature
+        probed = list(self.scorer.path_probe.paths)
+        for i, sig in enumerate(signatures):
+            if i not in rescore:
+                probed.extend(p for p in sig['paths'] if p in self.record['paths'])
+        self.carry(signatures, results, probed, len(rescore))
+        return results
+
+    def carry(self, signatures, results, probed, rescored=0):
+        # records the results to save as the host's last result
+        self.path_probe = self.paths.probe_for(probed)
+        self.results = dict(zip([signature_key(sig) for sig in signatures], results))
+        self.stats = dict(changed_categories=self.changed_categories, changed_paths=self.changed_paths,
+                          rescored=rescored, carried=len(signatures) - rescored)
+
+
+class ActionModule(ActionBase):
+
+    TRANSFERS_FILES = False
+
+    def find_module(self):
+        path = self._shared_loader_obj.module_loader.find_plugin('application_id', mod_type='.py')
+        if path is None:
+            path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'library',
+                                'application_id.py')
+        return path
+
+    def remote_probe(self, aid, task_vars, paths, timeout=None, scandir=False):
+        # checks paths with a single execution of the module on the host
+        probe = aid.PathProbe(paths, timeout, scandir)
+        if not probe.paths:
+            return probe
+        result = self._execute_module(module_name='application_id',
+                                      module_args=dict(probe_paths=probe.paths, path_timeout=timeout,
+                                                       path_scandir=scandir),
+                                      task_vars=task_vars)
+        if result.get('failed'):
+            raise AnsibleError("Unable to check application signature paths: %s" % result.get('msg'))
+        probe.results = result['path_results']
+        probe.timed_out = result['path_probe']['timed_out']
+        return probe
+
+    def score(self, aid, params, task_vars, index):
+        paths = RemotePaths(self, aid, task_vars, params['path_timeout'], params['path_scandir'])
+        scorer = aid.SignatureScorer(index, params['process_hits'], params['path_timeout'], params['path_scandir'],
+                                     params['short_circuit'], explain=params['explain'], path_prober=paths.prober)
+
+        # Paths are checked with a single remote call: the other categories
+        # are scored first, then every path of the signatures is checked
+        # together with the paths the memo entry and the last result need
+        memo = None
+        entry = None
+        if params['memo_dir'] and not params['explain']:
+            # The facts key maps to the paths scoring needed for those facts,
+            # the facts key and the path results to the result itself.  The
+            # explain output is measured on each host, it is never memoized
+            memo = MemoStore(params['memo_dir'], params['memo_size'])
+            keyed = dict((k, v) for k, v in params.items() if k not in UNKEYED_ARGS)
+            facts_key = sha1([index.fingerprint(), _application_id_sha1, keyed])
+            entry = memo.get(facts_key)
+            if entry is not None:
+                paths.expected.extend(entry['paths'])
+
+        state = None
+        if params['state_dir'] and params['signatures']:
+            keyed = dict((k, v) for k, v in params.items() if k not in UNKEYED_SIGNATURE_ARGS)
+            state = HostState(params['state_dir'], task_vars.get('inventory_hostname', 'localhost'),
+                              sha1([_application_id_sha1, keyed]))
+            record = state.load()
+            if record is not None:
+                paths.expected.extend(record['paths'])
+            scorer = IncrementalScorer(aid, scorer, paths, record, index.fingerprints())
+
+        result = None
+        if entry is not None:
+            # the entry holds every path scoring these facts needs, so a
+            # miss does not check any other path
+            paths.probe(paths.expected)
+            result = memo.get(sha1([facts_key, paths.probe_for(entry['paths']).results]))
+        hit = result is not None
+        if result is None:
+            result = aid.identify(params, scorer)
+            if memo is not None:
+                memo.put(facts_key, dict(paths=scorer.path_probe.paths))
+                memo.put(sha1([facts_key, paths.probe_for(scorer.path_probe.paths).results]), result)
+        elif state is not None:
+            # a memoized result is the host's new last result too, the
+            # signatures its own last result does not cover count as rescored
+            signatures = [aid.normalize_signature(sig) for sig in params['signatures']]
+            scorer.check_paths()
+            scorer.carry(signatures, result['signature_results'], entry['paths'], scorer.rescored(signatures))
+
+        if memo is not None:
+            result['memo'] = memo.record(hit)
+        if state is not None:
+            state.save(scorer.fingerprints, scorer.path_probe.results, scorer.results)
+            result['incremental'] = scorer.stats
+        return result
+
+    def run(self, tmp=None, task_vars=None):
+        if task_vars is None:
+            task_vars = dict()
+
+        result = super(ActionModule, self).run(tmp, task_vars)
+        del tmp
+
+        args = dict(self._task.args)
+        if args.get('scoring', 'controller') == 'remote' or ArgumentSpecValidator is None:
+            result.update(self._execute_module(module_name='application_id', module_args=args, task_vars=task_vars))
+            return result
+
+        aid = load_application_id(self.find_module())
+        validated = ArgumentSpecValidator(aid.MODULE_ARGS, required_one_of=aid.REQUIRED_ONE_OF).validate(args)
+        if validated.error_messages:
+            result['failed'] = True
+            result['msg'] = ', '.join(validated.error_messages)
+            return result
+        params = validated.validated_parameters
+
+        if params['probe_paths'] is not None:
+            result.update(self._execute_module(module_name='application_id', module_args=args, task_vars=task_vars))
+            return result
+
+        try:
+            result.update(self.score(aid, params, task_vars, aid.FactIndex(params['facts'])))
+        except ValueError as e:
+            result['failed'] = True
+            result['msg'] = str(e)
+        return result
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+# Benchmarks the 'ps auxww' parser of the amf-discovery-processes role's
+# process_facts module against the parser it replaced, which searched every
+# line with the same regular expression twelve times.
+#
+# By default the input is synthetic 'ps auxww' output of 1k, 10k and 100k
+# process hosts, mixing long (truncated) user names, every START format,
+# kernel threads and long command lines.  Output recorded on real hosts
+# (ps auxww > host.txt) can be given with --input instead.  Every input is
+# parsed from a file, the way the module reads the pipe from ps, and both
+# parsers must return the same processes.
+#
+# Results are written as JSON to benchmarks/results/ps_parser-<label>.json.
+#
+# Usage:
+#   ./benchmarks/ps_parser_benchmark.py
+#   ./benchmarks/ps_parser_benchmark.py --input recorded/*.txt
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCHMARK_FORMAT = 1
+HEADER = 'USER       PID %CPU %MEM    VSZ   RSS TTY      STAT START   TIME COMMAND'
+
+
+def load_process_facts():
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'roles',
+                        'amf-discovery-processes', 'library', 'process_facts.py')
+    import importlib.util
+    spec = importlib.util.spec_from_file_location('process_facts', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def legacy_parse(f):
+    # the parser process_facts used before, kept as the reference.  It read
+    # all of the output of ps before splitting it
+    re_header = re.compile(r'^USER+.*')
+    procs = list()
+    for l in f.read().split('\n'):
+        if len(l) > 0 and re_header.search(l) is None:
+            procs.append(l.replace('\n', '').replace('\t', '    '))
+
+    re_ps = re.compile(r'^(?P<user>[\w\+\-\_\$\d]+)\s+(?P<pid>[0-9]+)\s+(?P<cpu>[0-9\.]+)\s+(?P<mem>[0-9\.]+)\s+(?P<vsz>[0-9]+)\s+(?P<rss>[0-9]+)\s+(?P<tty>[a-zA-Z0-9\?\/\-]+)\s+(?P<stat>[ADIRSTtWXZ\<NLsl\+]+)\s+(?P<start>[\w\:\d]+\s?[\d]{2})\s+(?P<time>[0-9\:]+)\s+(?P<command>.*)$')
+    processes = list()
+    for proc in procs:
+        process = dict()
+        if re_ps.search(proc):
+            process['user'] = re_ps.search(proc).group('user')
+            process['pid'] = re_ps.search(proc).group('pid')
+            process['cpu_percentage'] = re_ps.search(proc).group('cpu')
+            process['memory_percentage'] = re_ps.search(proc).group('mem')
+            process['virtual_memory_size'] = re_ps.search(proc).group('vsz')
+            process['resident_size'] = re_ps.search(proc).group('rss')
+            process['teletype'] = re_ps.search(proc).group('tty')
+            process['stat'] = re_ps.search(proc).group('stat')
+            process['start'] = re_ps.search(proc).group('start')
+            process['time'] = re_ps.search(proc).group('time')
+            process['command'] = re_ps.search(proc).group('command')
+            processes.append(process)
+    return processes, len(procs)
+
+
+def synthetic_ps(rnd, count):
+    # 'ps auxww' output of a host running count processes
+    users = ['root', 'apache', 'postgres', 'oracle', 'svc_batc+', 'jboss', 'nobody']
+    starts = ['07:05', 'Jul08', 'Dec31', '2019']
+    lines = [HEADER]
+    for pid in range(1, count + 1):
+        if pid < count // 50:
+            command = '[kworker/%d:%d-events]' % (pid % 8, pid % 3)
+            vsz = rss = 0
+            tty = '?'
+            stat = 'I<'
+        else:
+            daemon = 'daemon%d' % (pid % 300)
+            command = '/opt/app%d/bin/%s --config /etc/%s/%s.conf %s' % (
+                pid % 40, daemon, daemon, daemon, ' '.join('-Dopt%d=value%d' % (i, i) for i in range(pid % 30)))
+            vsz = rnd.randint(10000, 9000000)
+            rss = rnd.randint(1000, vsz)
+            tty = 'pts/%d' % (pid % 10) if pid % 17 == 0 else '?'
+            stat = rnd.choice(['Ss', 'S', 'Sl', 'R+', 'SNl', 'D<'])
+        lines.append('%-8s %5d %4.1f %4.1f %6d %5d %-8s %-4s %5s %6s %s' % (
+            rnd.choice(users), pid, rnd.random() * 20, rnd.random() * 5, vsz, rss, tty, stat, rnd.choice(starts),
+            '%d:%02d' % (rnd.randint(0, 5000), rnd.randint(0, 59)), command))
+    return '\n'.join(lines) + '\n'
+
+
+def measure(parse, path, repeat):
+    # fastest time and the peak memory of parsing the file at path
+    best = None
+    for _ in range(repeat):
+        with open(path) as f:
+            start = time.time()
+            result = parse(f)
+            elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    with open(path) as f:
+        parse(f)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the process_facts 'ps auxww' parser")
+    parser.add_argument('--sizes', default='1000,10000,100000', help='comma separated synthetic process counts')
+    parser.add_argument('--input', nargs='*', default=list(), help="recorded 'ps auxww' output files")
+    parser.add_argument('--repeat', type=int, default=3, help='runs per input, the fastest is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--label', default='latest', help='name of the results file')
+    parser.add_argument('--output', help='results file, defaults to benchmarks/results/ps_parser-<label>.json')
+    args = parser.parse_args()
+
+    process_facts = load_process_facts()
+    rnd = random.Random(args.seed)
+
+    inputs = list()
+    tmpdir = tempfile.mkdtemp(prefix='ps_parser_benchmark')
+    if args.input:
+        inputs = [(os.path.basename(path), path) for path in args.input]
+    else:
+        for size in [int(s) for s in args.sizes.split(',')]:
+            path = os.path.join(tmpdir, 'ps-%d.txt' % size)
+            with open(path, 'w') as f:
+                f.write(synthetic_ps(rnd, size))
+            inputs.append(('synthetic-%d' % size, path))
+
+    results = dict(
+        format=BENCHMARK_FORMAT,
+        label=args.label,
+        date=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        python=platform.python_version(),
+        machine=platform.machine(),
+        results=list()
+    )
+    mismatches = 0
+    print('%-20s %8s %10s %10s %8s %12s %12s' % ('input', 'lines', 'legacy s', 'parser s', 'speedup', 'legacy MiB',
+                                                'parser MiB'))
+    for name, path in inputs:
+        legacy, legacy_time, legacy_peak = measure(legacy_parse, path, args.repeat)
+        parsed, parser_time, parser_peak = measure(process_facts.parse_ps_lines, path, args.repeat)
+        same = legacy == parsed
+        if not same:
+            mismatches += 1
+        r = dict(input=name, lines=legacy[1], processes=len(parsed[0]), legacy=round(legacy_time, 6),
+                 parser=round(parser_time, 6), legacy_peak_memory=legacy_peak, parser_peak_memory=parser_peak,
+                 same_output=same)
+        results['results'].append(r)
+        print('%-20s %8d %10.4f %10.4f %7.1fx %12.1f %12.1f%s' % (
+            name, r['lines'], legacy_time, parser_time, legacy_time / parser_time if parser_time else 0,
+            legacy_peak / 1048576.0, parser_peak / 1048576.0, '' if same else '  OUTPUT DIFFERS'))
+
+    for name, path in inputs:
+        if path.startswith(tmpdir):
+            os.remove(path)
+    os.rmdir(tmpdir)
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results',
+                                         'ps_parser-%s.json' % args.label)
+    if not os.path.isdir(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
+    print('Results written to %s' % output)
+    if mismatches:
+        sys.exit('%d inputs parsed differently from the legacy parser' % mismatches)
+
+
+if __name__ == '__main__':
+    main()
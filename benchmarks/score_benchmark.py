@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+# Benchmarks the signature scoring of library/application_id.py against a
+# synthetic host and synthetic signature catalogs.
+#
+# The host has the size of a large application server (by default 10k
+# processes, 5k packages, 50k users and 2k listeners).  The catalogs mix
+# every signature syntax (process regex/glob/exe patterns, versioned
+# packages, port ranges) and are built so part of them hit the host, which
+# keeps the short-circuit from discarding everything after the first
+# category.  Paths are scored from pre-collected results, the benchmark
+# does not touch the file system.
+#
+# For every catalog size it reports:
+#   - index:    seconds to build the FactIndex of the host
+#   - cold:     seconds to score the catalog with an empty process matcher
+#               cache (module executed on the host)
+#   - warm:     seconds to score it with the matcher cached (action plugin
+#               scoring many hosts on the controller)
+#   - throughput in signatures per second, cold
+#   - the seconds spent per category, from explain
+#   - the peak memory of indexing and scoring, from tracemalloc
+#
+# Results are written as JSON to benchmarks/results/<label>.json, and
+# compared against an earlier results file with --baseline.  A baseline
+# measured on another host size, seed or process_hits setting is refused,
+# one measured with another Python version or machine only warned about.
+#
+# Usage:
+#   ./benchmarks/score_benchmark.py --label "$(git describe --always)" --baseline benchmarks/results/baseline.json
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+BENCHMARK_FORMAT = 1
+
+
+def load_application_id():
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'library', 'application_id.py')
+    import importlib.util
+    spec = importlib.util.spec_from_file_location('application_id', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def synthetic_facts(rnd, processes, packages, users, listeners):
+    # fact subset of a single host, as collected by discovery.yml
+    facts = dict(
+        services=dict(),
+        packages=dict(),
+        running_processes=dict(processes=list()),
+        tcp_listen=list(),
+        udp_listen=list(),
+        local_users=[dict(user='user%d' % i, uid=1000 + i) for i in range(users)],
+        local_groups=[dict(group='group%d' % i, gid=1000 + i) for i in range(users // 10)]
+    )
+    for i in range(packages):
+        facts['packages']['pkg%d' % i] = [dict(name='pkg%d' % i, version='%d.%d.%d' % (i % 7, i % 13, i % 31),
+                                               release='%d.el7' % (i % 5), epoch=None, arch='x86_64')]
+        if i % 10 == 0:
+            facts['services']['svc%d.service' % i] = dict(name='svc%d.service' % i, state='running',
+                                                          source='systemd')
+    for i in range(processes):
+        daemon = 'daemon%d' % (i % 500)
+        facts['running_processes']['processes'].append(dict(
+            user='user%d' % (i % users), pid=i + 1, command='/opt/app%d/bin/%s --config /etc/%s/%s.conf -w %d' %
+            (i % 50, daemon, daemon, daemon, rnd.randint(1, 64))))
+    for i in range(listeners):
+        protocol = 'tcp' if i % 4 else 'udp'
+        facts['%s_listen' % protocol].append(dict(port=1024 + i * 3, address='0.0.0.0', protocol=protocol,
+                                                  name='daemon%d' % (i % 500), pid=i + 1))
+    return facts
+
+
+def synthetic_signature(rnd, i, facts):
+    # every third signature is built from what the host has, the others
+    # miss in one randomly chosen category
+    hit = i % 3 == 0
+    n_processes = len(facts['running_processes']['processes'])
+    n_packages = len(facts['packages'])
+    n_users = len(facts['local_users'])
+
+    def maybe(name):
+        return name if hit or rnd.random() < 0.5 else 'missing-' + name
+
+    pkg = rnd.randrange(n_packages)
+    daemon = 'daemon%d' % rnd.randrange(min(500, n_processes) or 1)
+    processes = [maybe(daemon + ' '),
+                 're:' + maybe('/opt/app[0-9]+/bin/' + daemon) + r'\b',
+                 'glob:*/' + maybe(daemon) + ' --config *',
+                 'exe:' + maybe(daemon)]
+    tcp = facts['tcp_listen'][rnd.randrange(len(facts['tcp_listen']))] if facts['tcp_listen'] else None
+    return dict(
+        application=dict(name='Application %d' % i, desc='Synthetic application %d' % i),
+        services=[maybe('svc%d.service' % (rnd.randrange(n_packages // 10 or 1) * 10))],
+        packages=[maybe('pkg%d' % pkg), maybe('pkg%d >= 0.0' % rnd.randrange(n_packages)) + ', < 99'],
+        users=[maybe('user%d' % rnd.randrange(n_users))],
+        groups=[maybe('group%d' % rnd.randrange(n_users // 10 or 1))],
+        ports=['tcp/%d-%d' % (tcp['port'] - 1, tcp['port'] + 1) if tcp and maybe('') == '' else 'tcp/1',
+               dict(port=tcp['port'] if tcp else 1, protocol='tcp', process=daemon)],
+        processes=processes,
+        paths=['/opt/app%d/bin' % (i % 50), '/opt/app%d/etc' % (i % 50)],
+        scores=dict(services=1, packages=2, users=1, groups=1, ports=1, processes=2, paths=1)
+    )
+
+
+def run_size(aid, facts, path_results, signatures, repeat, process_hits):
+    def scorer(index, explain=False):
+        return aid.SignatureScorer(index, process_hits, path_results=path_results, explain=explain)
+
+    timings = dict(index=list(), cold=list(), warm=list())
+    for _ in range(repeat):
+        start = time.time()
+        index = aid.FactIndex(facts)
+        timings['index'].append(time.time() - start)
+
+        aid._process_matchers.clear()
+        start = time.time()
+        results = scorer(index).score(signatures)
+        timings['cold'].append(time.time() - start)
+
+        start = time.time()
+        scorer(index).score(signatures)
+        timings['warm'].append(time.time() - start)
+
+    # per category seconds, the shared work of a category plus the time
+    # spent on every signature in it
+    aid._process_matchers.clear()
+    explained = scorer(aid.FactIndex(facts), explain=True)
+    explained.score(signatures)
+    categories = dict((c, explained.explain['stages'].get(c, 0.0)) for c in aid.COST_ORDER)
+    for sig in explained.explain['signatures']:
+        for category, seconds in sig['timings'].items():
+            categories[category] += seconds
+
+    aid._process_matchers.clear()
+    tracemalloc.start()
+    scorer(aid.FactIndex(facts)).score(signatures)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    best = dict((k, min(v)) for k, v in timings.items())
+    return dict(
+        signatures=len(signatures),
+        identified=len([r for r in results if r['identified']]),
+        index=round(best['index'], 6),
+        cold=round(best['cold'], 6),
+        warm=round(best['warm'], 6),
+        signatures_per_second=round(len(signatures) / best['cold'], 1) if best['cold'] else None,
+        categories=dict((c, round(s, 6)) for c, s in categories.items()),
+        peak_memory=peak
+    )
+
+
+# results that must match the baseline's for the timings to be compared,
+# and those that only make the comparison less reliable
+WORKLOAD_KEYS = ['format', 'host', 'process_hits', 'seed']
+ENVIRONMENT_KEYS = ['python', 'machine']
+
+
+def differences(results, baseline, keys):
+    # the keys whose value differs from the baseline, keys an older
+    # baseline did not record are not compared
+    return ['%s %s -> %s' % (key, baseline[key], results.get(key))
+            for key in keys if key in baseline and baseline[key] != results.get(key)]
+
+
+def compare(results, baseline, tolerance):
+    # returns the lines describing every timing that got slower than the
+    # baseline by more than tolerance (a fraction)
+    regressions = list()
+    previous = dict((r['signatures'], r) for r in baseline['results'])
+    for r in results['results']:
+        old = previous.get(r['signatures'])
+        if old is None:
+            continue
+        for key in ['index', 'cold', 'warm', 'peak_memory']:
+            if old[key] and r[key] > old[key] * (1 + tolerance):
+                regressions.append('%d signatures: %s %s -> %s (+%.0f%%)' % (
+                    r['signatures'], key, old[key], r[key], (float(r[key]) / old[key] - 1) * 100))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark application signature scoring')
+    parser.add_argument('--sizes', default='10,100,1000', help='comma separated catalog sizes')
+    parser.add_argument('--processes', type=int, default=10000)
+    parser.add_argument('--packages', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--listeners', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3, help='runs per size, the fastest is reported')
+    parser.add_argument('--process-hits', default='process', choices=['process', 'pattern'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--label', default='latest', help='name of the results file')
+    parser.add_argument('--output', help='results file, defaults to benchmarks/results/<label>.json')
+    parser.add_argument('--baseline', help='earlier results file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown against the baseline reported as a regression (default 0.2, 20%%)')
+    args = parser.parse_args()
+
+    aid = load_application_id()
+    rnd = random.Random(args.seed)
+    facts = synthetic_facts(rnd, args.processes, args.packages, args.users, args.listeners)
+    sizes = [int(s) for s in args.sizes.split(',')]
+    catalog = [aid.normalize_signature(synthetic_signature(rnd, i, facts)) for i in range(max(sizes))]
+    path_results = dict()
+    for sig in catalog:
+        for i, path in enumerate(sig['paths']):
+            path_results[path] = i == 0
+
+    results = dict(
+        format=BENCHMARK_FORMAT,
+        label=args.label,
+        date=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        python=platform.python_version(),
+        machine=platform.machine(),
+        host=dict(processes=args.processes, packages=args.packages, users=args.users, listeners=args.listeners),
+        process_hits=args.process_hits,
+        seed=args.seed,
+        results=list()
+    )
+    print('%8s %10s %10s %10s %10s %12s %12s' % ('sigs', 'identified', 'index s', 'cold s', 'warm s', 'sigs/s',
+                                                'peak MiB'))
+    for size in sizes:
+        r = run_size(aid, facts, path_results, catalog[:size], args.repeat, args.process_hits)
+        results['results'].append(r)
+        print('%8d %10d %10.4f %10.4f %10.4f %12s %12.1f' % (
+            r['signatures'], r['identified'], r['index'], r['cold'], r['warm'], r['signatures_per_second'],
+            r['peak_memory'] / 1048576.0))
+        print('%8s %s' % ('', ', '.join('%s %.4f' % (c, r['categories'][c]) for c in aid.COST_ORDER)))
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results',
+                                         '%s.json' % args.label)
+    if not os.path.isdir(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
+    print('Results written to %s' % output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        workload = differences(results, baseline, WORKLOAD_KEYS)
+        if workload:
+            sys.exit('Not comparable with %s, the workload differs: %s' % (args.baseline, ', '.join(workload)))
+        for line in differences(results, baseline, ENVIRONMENT_KEYS):
+            print('Warning: measured in another environment than %s: %s' % (args.baseline, line))
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print('Regression: %s' % line)
+        if regressions:
+            sys.exit(1)
+        print('No regressions against %s' % args.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+# Filters for the running_processes fact returned by process_facts.
+#
+#   running_processes | expand_processes
+#       the processes as a list of dictionaries, whether running_processes
+#       was returned with output_format rows or columns
+#
+#   running_processes | process_column('command')
+#       the values of a single field for every process, without building
+#       the dictionaries
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+
+def process_column(running_processes, field):
+    running_processes = running_processes or dict()
+    columns = running_processes.get('columns')
+    if columns is None:
+        return [p.get(field) for p in running_processes.get('processes') or []]
+    column = columns.get(field) or list()
+    values = (running_processes.get('values') or dict()).get(field)
+    if values is not None:
+        return [values[i] for i in column]
+    return list(column)
+
+
+def expand_processes(running_processes):
+    running_processes = running_processes or dict()
+    columns = running_processes.get('columns')
+    if columns is None:
+        return running_processes.get('processes') or list()
+    fields = dict((f, process_column(running_processes, f)) for f in columns)
+    count = max([len(c) for c in fields.values()] or [0])
+    processes = list()
+    for i in range(count):
+        processes.append(dict((f, c[i]) for f, c in fields.items() if c[i] is not None))
+    return processes
+
+
+class FilterModule(object):
+    def filters(self):
+        return {
+            'expand_processes': expand_processes,
+            'process_column': process_column,
+        }
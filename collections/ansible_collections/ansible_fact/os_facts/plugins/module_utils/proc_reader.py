@@ -0,0 +1,425 @@
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+# Linux process collection straight from /proc, reporting the fields and
+# formats of 'ps auxww' without running any command
+
+import os
+import pwd
+import re
+import socket
+import struct
+import time
+from os.path import join
+
+PS_LINE = '%-8s %5s %4s %4s %6s %5s %-8s %-4s %5s %6s %s'
+STATUS_SIZES = re.compile(br'^(VmLck|VmSize|VmRSS):\s+(\d+)', re.M)
+# flag of kernel threads in /proc/<pid>/stat
+PF_KTHREAD = 0x00200000
+# /proc/net files of the sockets that can listen for connections, and the
+# state of a listening socket (TCP_LISTEN, TCP_CLOSE for unconnected udp)
+NET_FILES = [('tcp', 'tcp', b'0A'), ('tcp6', 'tcp', b'0A'), ('udp', 'udp', b'07'), ('udp6', 'udp', b'07')]
+ZERO_ADDRESS = re.compile(br'^0+:0+$')
+
+
+def compile_commands(option, patterns):
+    # every regular expression is compiled on its own, so inline flags and
+    # backreferences keep their meaning
+    searches = list()
+    for pattern in patterns:
+        try:
+            searches.append(re.compile(pattern).search)
+        except re.error as e:
+            raise re.error("%s regular expression '%s': %s" % (option, pattern, e))
+    return searches
+
+
+def process_filter(params):
+    # Returns a function telling whether a parsed process passes the filter
+    # options, None when no filter is set.  Raises re.error for an invalid
+    # regular expression.
+    include = compile_commands('include_commands', params['include_commands'])
+    exclude = compile_commands('exclude_commands', params['exclude_commands'])
+    users = set(params['users'])
+    min_rss = params['min_rss']
+    min_cpu = params['min_cpu']
+    drop_kernel_threads = params['drop_kernel_threads']
+    if not (include or exclude or users or min_rss or min_cpu or drop_kernel_threads):
+        return None
+
+    def keep(p):
+        command = p['command']
+        if drop_kernel_threads and p['virtual_memory_size'] == '0' and command.startswith('[') and \
+                not command.endswith('<defunct>'):
+            return False
+        if users and p['user'] not in users:
+            return False
+        if min_rss and int(p['resident_size']) < min_rss:
+            return False
+        if min_cpu and float(p['cpu_percentage']) < min_cpu:
+            return False
+        if include and not any(search(command) is not None for search in include):
+            return False
+        if exclude and any(search(command) is not None for search in exclude):
+            return False
+        return True
+    return keep
+
+
+def net_address(address):
+    # address and port of a /proc/net address, printed as hexadecimal words
+    # in host byte order
+    ip, port = address.split(':')
+    if len(ip) == 8:
+        ip = socket.inet_ntop(socket.AF_INET, struct.pack('=I', int(ip, 16)))
+    else:
+        ip = socket.inet_ntop(socket.AF_INET6, struct.pack('=4I', *[int(ip[i:i + 8], 16) for i in range(0, 32, 8)]))
+    return ip, int(port, 16)
+
+
+def read_file(path):
+    # raw read, /proc files are small and the io layers cost more than the
+    # read itself
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        chunks = list()
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        os.close(fd)
+    return b''.join(chunks)
+
+
+class ProcReader(object):
+    # Reads the running processes from /proc and reports them with the
+    # fields and formats of 'ps auxww', without running ps
+    def __init__(self, proc='/proc'):
+        self.proc = proc
+        self.hz = os.sysconf('SC_CLK_TCK')
+        self.page_kb = os.sysconf('SC_PAGE_SIZE') // 1024
+        self.now = time.time()
+        self.uptime = float(read_file(join(proc, 'uptime')).split()[0])
+        self.boot_time = self.now - self.uptime
+        for line in read_file(join(proc, 'stat')).splitlines():
+            if line.startswith(b'btime '):
+                self.boot_time = int(line.split()[1])
+                break
+        self.mem_total = 0
+        for line in read_file(join(proc, 'meminfo')).splitlines():
+            if line.startswith(b'MemTotal:'):
+                self.mem_total = int(line.split()[1])
+                break
+        self.user_names = dict()
+
+    def user_name(self, uid):
+        name = self.user_names.get(uid)
+        if name is None:
+            try:
+                name = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                name = str(uid)
+            self.user_names[uid] = name
+        return name
+
+    def tty_name(self, tty_nr):
+        if tty_nr == 0:
+            return '?'
+        major = os.major(tty_nr)
+        minor = os.minor(tty_nr)
+        if 136 <= major <= 143:
+            return 'pts/%d' % ((major - 136) * 256 + minor)
+        if major == 4:
+            return 'tty%d' % minor if minor < 64 else 'ttyS%d' % (minor - 64)
+        return '?'
+
+    def start_time(self, starttime):
+        started = self.boot_time + float(starttime) / self.hz
+        age = self.now - started
+        if age > 365 * 86400:
+            return time.strftime('%Y', time.localtime(started))
+        if age > 86400:
+            return time.strftime('%b%d', time.localtime(started))
+        return time.strftime('%H:%M', time.localtime(started))
+
+    def read_process(self, pid, kernel_threads=True):
+        # raises IOError/OSError when the process exited meanwhile, returns
+        # None for a kernel thread unless kernel_threads
+        path = '%s/%s/' % (self.proc, pid)
+        stat = read_file(path + 'stat')
+        # the command name is in parenthesis and may contain both spaces
+        # and parenthesis
+        end = stat.rindex(b')')
+        comm = stat[stat.index(b'(') + 1:end].decode('utf-8', 'replace')
+        fields = stat[end + 2:].split()
+        if not kernel_threads and int(fields[6]) & PF_KTHREAD:
+            return None
+        state = fields[0].decode('ascii')
+        ppid = fields[1].decode('ascii')
+        pgrp = int(fields[2])
+        session = int(fields[3])
+        tty_nr = int(fields[4])
+        tpgid = int(fields[5])
+        cpu_ticks = int(fields[11]) + int(fields[12])
+        nice = int(fields[16])
+        threads = int(fields[17])
+        starttime = int(fields[19])
+
+        # the effective user, and the exact memory sizes, are only in status
+        status = read_file(path + 'status')
+        start = status.index(b'\nUid:') + 5
+        uid = int(status[start:status.index(b'\n', start)].split()[1])
+        sizes = dict(STATUS_SIZES.findall(status))
+        vsz = int(sizes.get(b'VmSize', int(fields[20]) // 1024))
+        rss = int(sizes.get(b'VmRSS', int(fields[21]) * self.page_kb))
+        locked = int(sizes.get(b'VmLck', 0)) > 0
+
+        command = read_file(path + 'cmdline').rstrip(b'\0').replace(b'\0', b' ')
+        command = command.decode('utf-8', 'replace').replace('\n', ' ').replace('\t', ' ')
+        if not command:
+            command = '[%s]' % comm
+            if state == 'Z':
+                command += ' <defunct>'
+
+        # ps reports lifetime cpu usage and memory usage in tenths of a
+        # percent, truncated
+        elapsed = self.uptime - float(starttime) / self.hz
+        pcpu = int(cpu_ticks * 1000 // self.hz / elapsed) if elapsed > 0 else 0
+        pmem = rss * 1000 // self.mem_total if self.mem_total else 0
+        cpu_seconds = cpu_ticks // self.hz
+
+        flags = state
+        if nice < 0:
+            flags += '<'
+        elif nice > 0:
+            flags += 'N'
+        if locked:
+            flags += 'L'
+        if session == int(pid):
+            flags += 's'
+        if threads > 1:
+            flags += 'l'
+        if tpgid == pgrp:
+            flags += '+'
+
+        return dict(
+            user=self.user_name(uid),
+            pid=pid,
+            ppid=ppid,
+            cpu_percentage='%d.%d' % (pcpu // 10, pcpu % 10),
+            memory_percentage='%d.%d' % (pmem // 10, pmem % 10),
+            virtual_memory_size=str(vsz),
+            resident_size=str(rss),
+            teletype=self.tty_name(tty_nr),
+            stat=flags,
+            start=self.start_time(starttime),
+            time='%d:%02d' % (cpu_seconds // 60, cpu_seconds % 60),
+            command=command
+        )
+
+    def processes(self, keep=None, kernel_threads=True):
+        # Returns the processes keep (a function, see process_filter) is
+        # True for, and the number of running processes
+        processes = list()
+        total = 0
+        for pid in sorted((p for p in os.listdir(self.proc) if p.isdigit()), key=int):
+            try:
+                process = self.read_process(pid, kernel_threads)
+            except (IOError, OSError, ValueError, IndexError):
+                # exited while being read
+                continue
+            total += 1
+            if process is not None and (keep is None or keep(process)):
+                processes.append(process)
+        return processes, total
+
+
+class ProcSampler(object):
+    # Samples the cpu ticks of every process from /proc/<pid>/stat alone,
+    # samples times over window seconds, to report the cpu usage of every
+    # process during the window instead of its lifetime average.  Every
+    # process is read in full once, by the sample it is first seen in, so
+    # the ones that exit before the end of the window are still reported and
+    # the result is built from the samples without reading /proc again.
+    # Samples are spaced so the cpu time the sampler uses, full reads
+    # included, stays below cpu_budget percent of the time elapsed, samples
+    # that would not fit in the window are dropped.
+    def __init__(self, samples, window, cpu_budget, proc='/proc'):
+        self.samples = samples
+        self.window = window
+        self.cpu_budget = cpu_budget
+        self.proc = proc
+        self.hz = os.sysconf('SC_CLK_TCK')
+        self.first = dict()
+        self.last = dict()
+        # (pid, starttime) -> process read in full, None when not kept
+        self.read = dict()
+        self.appeared = set()
+        self.taken = 0
+        self.cpu_seconds = 0.0
+        self.elapsed = 0.0
+
+    def ticks(self):
+        # (pid, starttime) -> cpu ticks of every running process
+        snapshot = dict()
+        for pid in os.listdir(self.proc):
+            if not pid.isdigit():
+                continue
+            try:
+                stat = read_file('%s/%s/stat' % (self.proc, pid))
+                fields = stat[stat.rindex(b')') + 2:].split()
+                snapshot[(pid, fields[19])] = int(fields[11]) + int(fields[12])
+            except (IOError, OSError, ValueError, IndexError):
+                continue
+        return snapshot
+
+    def sample(self, keep=None, kernel_threads=True):
+        now = time.time()
+        snapshot = self.ticks()
+        reader = None
+        for key, ticks in snapshot.items():
+            if key not in self.first:
+                self.first[key] = (now, ticks)
+                if reader is None:
+                    reader = ProcReader(self.proc)
+                self.read_process(reader, key, keep, kernel_threads)
+                if self.taken > 0:
+                    # appeared since the previous sample
+                    self.appeared.add(key)
+            self.last[key] = (now, ticks)
+        self.taken += 1
+        return snapshot
+
+    def read_process(self, reader, key, keep=None, kernel_threads=True):
+        try:
+            process = reader.read_process(key[0], kernel_threads)
+        except (IOError, OSError, ValueError, IndexError):
+            # exited meanwhile, read again at the end of the window if it
+            # is still running
+            return
+        self.read[key] = process if process is not None and (keep is None or keep(process)) else None
+
+    def cpu_percentage(self, key):
+        # cpu usage between the first and the last sample the process was
+        # seen in, None when it was seen in a single one
+        first_time, first_ticks = self.first[key]
+        last_time, last_ticks = self.last[key]
+        if last_time <= first_time:
+            return None
+        return '%.1f' % ((last_ticks - first_ticks) * 100.0 / self.hz / (last_time - first_time))
+
+    def processes(self, keep=None, kernel_threads=True):
+        # Returns the processes running at the last sample, the processes
+        # that appeared and exited during the window, and the number of
+        # processes running at the last sample
+        start = time.time()
+        start_cpu = sum(os.times()[:2])
+        interval = float(self.window) / (self.samples - 1)
+        snapshot = self.sample(keep, kernel_threads)
+        for i in range(1, self.samples):
+            cpu = sum(os.times()[:2]) - start_cpu
+            due = max(start + i * interval, start + cpu * 100.0 / self.cpu_budget)
+            if due > start + self.window + interval / 2:
+                break
+            time.sleep(max(0, due - time.time()))
+            snapshot = self.sample(keep, kernel_threads)
+
+        # only the processes of the last sample that could not be read when
+        # first seen are read again
+        reader = None
+        for key in snapshot:
+            if key not in self.read:
+                if reader is None:
+                    reader = ProcReader(self.proc)
+                self.read_process(reader, key, keep, kernel_threads)
+        processes = list()
+        transient = list()
+        for key in sorted(self.read, key=lambda k: int(k[0])):
+            p = self.read[key]
+            if p is None or (key not in snapshot and key not in self.appeared):
+                continue
+            cpu = self.cpu_percentage(key)
+            if cpu is not None:
+                p['sampled_cpu_percentage'] = cpu
+            if key in snapshot:
+                processes.append(p)
+            else:
+                transient.append(p)
+        self.elapsed = time.time() - start
+        self.cpu_seconds = sum(os.times()[:2]) - start_cpu
+        return processes, transient, len(snapshot)
+
+
+class SocketIndex(object):
+    # Joins the sockets listening for connections, from /proc/net/tcp, tcp6,
+    # udp and udp6, to the processes holding them, from the socket:[inode]
+    # links in /proc/<pid>/fd, in a single sweep without running any
+    # command.  Processes with more than max_fds open files are not swept,
+    # their number is kept in skipped.
+    def __init__(self, proc='/proc', max_fds=4096):
+        self.proc = proc
+        self.max_fds = max_fds
+        self.skipped = 0
+
+    def listeners(self):
+        # inode -> protocol, address and port of every listening socket
+        listeners = dict()
+        for name, protocol, state in NET_FILES:
+            try:
+                lines = read_file(join(self.proc, 'net', name)).splitlines()[1:]
+            except (IOError, OSError):
+                continue
+            for line in lines:
+                fields = line.split()
+                if len(fields) < 10 or fields[3] != state or (protocol == 'udp' and not ZERO_ADDRESS.match(fields[2])):
+                    continue
+                address, port = net_address(fields[1].decode('ascii'))
+                listeners[int(fields[9])] = dict(protocol=protocol, address=address, port=port)
+        return listeners
+
+    def owners(self, inodes):
+        # inode -> pids holding the socket, for the given inodes
+        owners = dict()
+        self.skipped = 0
+        for pid in sorted((p for p in os.listdir(self.proc) if p.isdigit()), key=int):
+            fd_dir = '%s/%s/fd' % (self.proc, pid)
+            try:
+                fds = os.listdir(fd_dir)
+                if len(fds) > self.max_fds:
+                    self.skipped += 1
+                    continue
+                for fd in fds:
+                    try:
+                        link = os.readlink('%s/%s' % (fd_dir, fd))
+                    except (IOError, OSError):
+                        continue
+                    if link.startswith('socket:['):
+                        inode = int(link[8:-1])
+                        if inode in inodes and pid not in owners.setdefault(inode, list()):
+                            owners[inode].append(pid)
+            except (IOError, OSError):
+                # exited, or not ours to read
+                continue
+        return owners
+
+    def join(self, processes):
+        # Sets listening, the sockets it listens on, on every process, and
+        # returns every listening socket with the pids holding it
+        listeners = self.listeners()
+        owners = self.owners(listeners)
+        by_pid = dict((p['pid'], p) for p in processes)
+        result = list()
+        for inode in sorted(listeners, key=lambda i: (listeners[i]['protocol'], listeners[i]['port'], i)):
+            listener = dict(listeners[inode], pids=owners.get(inode, list()))
+            for pid in listener['pids']:
+                if pid in by_pid:
+                    by_pid[pid].setdefault('listening', list()).append(listeners[inode])
+            result.append(listener)
+        return result
+
+
+def ps_line(process):
+    return PS_LINE % (process['user'], process['pid'], process['cpu_percentage'], process['memory_percentage'],
+                      process['virtual_memory_size'], process['resident_size'], process['teletype'],
+                      process['stat'], process['start'], process['time'], process['command'])
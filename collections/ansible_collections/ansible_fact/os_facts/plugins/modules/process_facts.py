@@ -15,6 +15,7 @@ version_added: "2.8"
 description:
     - "Collects the currently running processes on a system at the time the module is run."
     - "This module presents the currently running proceses as ansible_facts"
+    - "The filter options (include_commands, exclude_commands, users, min_rss, min_cpu and drop_kernel_threads) are applied on the host, before the output is built, to processes and ps_stdout_lines.  total_running_processes always counts every process."
 output_ps_stdout_lines:
     description:
         - Whether or not to output the collected standard out lines from the 'ps auxww' command
@@ -25,6 +26,108 @@ output_parsed_processes:
         - Whether or not to output parsed data from the 'ps auxww' command.
     default: True
     required: False
+backend:
+    description:
+        - How processes are collected.  C(proc) reads /proc/<pid>/stat, status and cmdline directly, without running any command, and reports the same fields as 'ps auxww'.  C(ps) runs and parses 'ps auxww'.  C(auto) uses C(proc) on Linux and C(ps) elsewhere.
+        - With C(proc), ps_stdout_lines are rendered from /proc in the 'ps auxww' layout.
+    default: auto
+    choices: [auto, proc, ps]
+    required: False
+output_format:
+    description:
+        - Layout of running_processes.  C(rows) returns processes as a list with one dictionary per process.
+        - C(columns) returns one list per field in running_processes.columns instead, so field names are not repeated for every process.  The repeated values of user, teletype, stat and start are interned, their column holds indexes into the list of distinct values in running_processes.values.  Use the expand_processes filter to turn it back into rows.
+    default: rows
+    choices: [rows, columns]
+    required: False
+include_commands:
+    description:
+        - Only return processes whose command matches (re.search) one of these regular expressions.
+    type: list
+    default: []
+    required: False
+exclude_commands:
+    description:
+        - Do not return processes whose command matches (re.search) one of these regular expressions.
+    type: list
+    default: []
+    required: False
+users:
+    description:
+        - Only return processes running as one of these users.
+    type: list
+    default: []
+    required: False
+min_rss:
+    description:
+        - Only return processes with a resident size of at least this many KiB.
+    type: int
+    default: 0
+    required: False
+min_cpu:
+    description:
+        - Only return processes with a cpu_percentage of at least this.
+    type: float
+    default: 0
+    required: False
+drop_kernel_threads:
+    description:
+        - Do not return kernel threads.  With the proc backend, kernel threads are skipped before their status and cmdline are read.
+    type: bool
+    default: False
+    required: False
+process_tree:
+    description:
+        - Also return running_processes.children, the pids of the children of every parent process, keyed by the parent pid.
+    type: bool
+    default: False
+    required: False
+collapse_workers:
+    description:
+        - Return the children of a parent running the same command as the same user (i.e. the workers of a prefork server) as a single entry, the first of them.  Its resident_size, cpu_percentage and memory_percentage are the totals of all of them, and workers is their number.  A process with no identical sibling is returned as is.
+        - ps_stdout_lines are not collapsed.
+    type: bool
+    default: False
+    required: False
+samples:
+    description:
+        - Number of /proc samples taken over sample_window seconds.  With more than one, every process gets a sampled_cpu_percentage, its cpu usage between the first and the last sample it was seen in (the cpu_percentage of ps is its lifetime average), and the processes that started and exited during the window are returned in running_processes.transient_processes.
+        - Samples only read /proc/<pid>/stat, every process is read in full once, by the first sample it is seen in, and reported with the ps fields of that read.  Requires the proc backend.
+    type: int
+    default: 1
+    required: False
+sample_window:
+    description:
+        - Seconds over which the samples are taken.
+    type: float
+    default: 10
+    required: False
+sample_cpu_budget:
+    description:
+        - Maximum cpu time the sampling may use, the full reads of the processes included, in percent of the time elapsed.  Samples are delayed to stay below it, and the ones that would then fall outside sample_window are not taken.
+    type: float
+    default: 5
+    required: False
+typed_fields:
+    description:
+        - Return pid, ppid, cpu_percentage, memory_percentage and sampled_cpu_percentage as numbers instead of strings, and virtual_memory_size and resident_size as a number of bytes instead of a string of KiB, so they can be compared and sorted without int or float filters.
+        - Filters (i.e. min_rss) are applied before the conversion, on the values of ps.
+    type: bool
+    default: False
+    required: False
+listening_ports:
+    description:
+        - Set listening, the sockets a process listens on (protocol, address and port), on every process, and return every listening socket with the pids holding it in running_processes.listeners.
+        - Listening sockets are read from /proc/net/tcp, tcp6, udp and udp6 and joined to processes from the socket links in /proc/<pid>/fd, in one sweep without running any command.  Linux only.  Sockets of processes the module can not read (i.e. when not run as root) have no pids.
+    type: bool
+    default: False
+    required: False
+max_fds:
+    description:
+        - With listening_ports, processes with more open files than this are not swept, and their sockets have no pids.
+    type: int
+    default: 4096
+    required: False
 author:
     - Andrew J. Huffman (@ahuffman)
     - John Westcott IV (@john-westcott-iv)
@@ -41,6 +144,32 @@ EXAMPLES = '''
     output_ps_stdout_lines: True
     output_parsed_processes: False
 
+# Collect processes as one list per field
+- name: "Collect current running processes in columns"
+  scan_processes:
+    output_format: columns
+
+# Collect processes with the workers of prefork servers collapsed
+- name: "Collect current running processes, collapsing workers"
+  scan_processes:
+    collapse_workers: True
+
+# Sample processes 6 times over a minute, to catch short-lived processes
+- name: "Sample running processes"
+  scan_processes:
+    samples: 6
+    sample_window: 60
+
+# Collect processes with numeric fields as numbers, sizes in bytes
+- name: "Collect current running processes, typed"
+  scan_processes:
+    typed_fields: True
+
+# Collect processes with the ports they listen on
+- name: "Collect current running processes and their listening ports"
+  scan_processes:
+    listening_ports: True
+
 # Collect both parsed process data and 'ps auxww' command standard out
 - name: "Collect all process data"
   scan_processes:
@@ -54,6 +183,7 @@ running_processes:
         cpu_percentage: '0.0'
         memory_percentage: '0.0'
         pid: '1'
+        ppid: '0'
         resident_size: '5036'
         start: Jul08
         stat: Ss
@@ -61,52 +191,240 @@ running_processes:
             time: '3:32'
             user: root
           ...
+        # with typed_fields
+        processes:
+          - command: /usr/lib/systemd/systemd --switched-root --system --deserialize 33
+            cpu_percentage: 0.0
+            pid: 1
+            resident_size: 5156864
+            ...
+          ...
         ps_stdout_lines:
           - root         1  0.0  0.0 171628  5056 ?        Ss   Jul08   3:32 /usr/lib/systemd/systemd --switched-root --system --deserialize 33
           ...
         total_running_processes: 359
+        # with samples, processes that started and exited during the window
+        transient_processes:
+          - command: /bin/sh -c /usr/local/bin/backup.sh
+            pid: '40411'
+            sampled_cpu_percentage: '3.1'
+            ...
+          ...
+        # with listening_ports
+        listeners:
+          - address: 0.0.0.0
+            pids: ['1234', '1240']
+            port: 80
+            protocol: tcp
+          ...
+        # with process_tree
+        children:
+          '1': ['567', '612', ...]
+          ...
+        # with output_format columns, instead of processes
+        columns:
+          command: [/usr/lib/systemd/systemd --switched-root --system --deserialize 33, ...]
+          pid: ['1', ...]
+          user: [0, ...]
+          ...
+        values:
+          user: [root, ...]
+          ...
+    # with samples, the samples taken, the seconds they took and the cpu
+    # seconds they used
+    sampling:
+        samples: 6
+        window: 60.004
+        cpu_seconds: 0.412
 '''
 
 from ansible_collections.ansible_fact.os_facts.plugins.module_utils.fact_gatherer import FactGatherer
+from ansible_collections.ansible_fact.os_facts.plugins.module_utils.proc_reader import ProcReader, ProcSampler, \
+    SocketIndex, process_filter, ps_line
+from os.path import isdir, isfile
 import re
+import subprocess
+import sys
+
+# one 'ps auxww' line, the groups are named after the process fields
+RE_PS = re.compile(r'^(?P<user>[\w\+\-\_\$]+)\s+(?P<pid>[0-9]+)\s+(?P<cpu_percentage>[0-9\.]+)\s+(?P<memory_percentage>[0-9\.]+)\s+(?P<virtual_memory_size>[0-9]+)\s+(?P<resident_size>[0-9]+)\s+(?P<teletype>[a-zA-Z0-9\?\/]+)\s+(?P<stat>[DIRSTtWXZ\<NLsl\+]+)\s+(?P<start>[A-Za-z0-9\:]+)\s+(?P<time>[0-9\:\.]+)\s+(?P<command>.*)$')
+
+
+def parse_ps_lines(lines, parse=True, raw_output=None, keep=None):
+    # Parses 'ps auxww' output as it is read from any iterable of lines (i.e.
+    # the pipe from ps), with a single match per line.  Every line is kept in
+    # raw_output when it is given.  With keep (see process_filter), only the
+    # processes and process lines it is True for are kept.  Returns the
+    # parsed processes and the number of process lines.
+    match = RE_PS.match
+    processes = list()
+    count = 0
+    for line in lines:
+        if not isinstance(line, str):
+            line = line.decode('utf-8', 'replace')
+        line = line.rstrip('\n')
+        m = None
+        if line and not line.startswith('USER'):
+            count += 1
+            if parse or keep is not None:
+                m = match(line)
+                if keep is not None and (m is None or not keep(m.groupdict())):
+                    continue
+        if raw_output is not None:
+            raw_output.append(line)
+        if parse and m is not None:
+            processes.append(m.groupdict())
+    return processes, count
+
+
+PROCESS_FIELDS = ['user', 'pid', 'ppid', 'cpu_percentage', 'memory_percentage', 'virtual_memory_size', 'resident_size',
+                  'teletype', 'stat', 'start', 'time', 'command']
+INTERNED_FIELDS = ['user', 'teletype', 'stat', 'start']
+
+
+# fields converted by typed_fields, with their type and the factor bringing
+# them to bytes
+NUMERIC_FIELDS = [('pid', int, 1), ('ppid', int, 1), ('cpu_percentage', float, 1), ('memory_percentage', float, 1),
+                  ('sampled_cpu_percentage', float, 1), ('virtual_memory_size', int, 1024),
+                  ('resident_size', int, 1024)]
+
+
+def type_fields(processes):
+    # converts the numeric fields of processes in place
+    for p in processes:
+        for field, kind, factor in NUMERIC_FIELDS:
+            v = p.get(field)
+            if v is not None:
+                p[field] = kind(v) * factor
+    return processes
+
+
+def to_columns(processes):
+    # One list per field instead of one dictionary per process, a field a
+    # process does not have is None.  Interned fields hold indexes into the
+    # list of their distinct values.
+    fields = list(PROCESS_FIELDS)
+    for p in processes:
+        for f in p:
+            if f not in fields:
+                fields.append(f)
+    columns = dict((f, list()) for f in fields)
+    values = dict((f, list()) for f in INTERNED_FIELDS)
+    interned = dict((f, dict()) for f in INTERNED_FIELDS)
+    for p in processes:
+        for f in fields:
+            v = p.get(f)
+            if f in interned:
+                i = interned[f].get(v)
+                if i is None:
+                    i = interned[f][v] = len(values[f])
+                    values[f].append(v)
+                v = i
+            columns[f].append(v)
+    return columns, values
+
+
+def process_children(processes):
+    # parent pid -> pids of its children
+    children = dict()
+    for p in processes:
+        if p.get('ppid') is not None:
+            children.setdefault(p['ppid'], list()).append(p['pid'])
+    return children
+
+
+def collapse_workers(processes):
+    # Identical children of a parent (same user and command) are returned
+    # as the first of them, holding the number of workers and their total
+    # resident size and cpu and memory percentages
+    groups = dict()
+    for p in processes:
+        if p.get('ppid') not in (None, '0'):
+            groups.setdefault((p['ppid'], p['user'], p['command']), list()).append(p)
+    collapsed = list()
+    for p in processes:
+        workers = groups.get((p.get('ppid'), p['user'], p['command']))
+        if workers is None or len(workers) < 2:
+            collapsed.append(p)
+        elif workers[0] is p:
+            p = dict(p)
+            p['workers'] = len(workers)
+            p['resident_size'] = str(sum(int(w['resident_size']) for w in workers))
+            p['cpu_percentage'] = '%.1f' % sum(float(w['cpu_percentage']) for w in workers)
+            p['memory_percentage'] = '%.1f' % sum(float(w['memory_percentage']) for w in workers)
+            collapsed.append(p)
+    return collapsed
+
+
+def parse_ppids(lines):
+    # pid -> parent pid, from the output of 'ps -e -o pid= -o ppid='
+    ppids = dict()
+    for line in lines:
+        fields = line.split()
+        if len(fields) == 2:
+            ppids[fields[0]] = fields[1]
+    return ppids
+
 
 class ProcessGatherer(FactGatherer):
     def get_processes(self, command):
-        re_header = re.compile(r'^USER+.*')
-        self.raw_processes = []
-#### How do we call run_command????
-        rc, stdout, stderr = self.run_command(command, check_rc=True)
-        for line in stdout.split('\n'):
-            self.raw_output.append(line)
-            if len(line) > 0 and re_header.search(line) is None:
-                self.raw_processes.append(line)
-
-    def parse_process_data(self):
-        re_ps = re.compile(r'^(?P<user>[\w\+\-\_\$]+)\s+(?P<pid>[0-9]+)\s+(?P<cpu>[0-9\.]+)\s+(?P<mem>[0-9\.]+)\s+(?P<vsz>[0-9]+)\s+(?P<rss>[0-9]+)\s+(?P<tty>[a-zA-Z0-9\?\/]+)\s+(?P<stat>[DIRSTtWXZ\<NLsl\+]+)\s+(?P<start>[A-Za-z0-9\:]+)\s+(?P<time>[0-9\:\.]+)\s+(?P<command>.*)$')
+        # streams the output of ps into the parser, so only the parsed
+        # processes are ever held in memory
+        try:
+            ps = subprocess.Popen(command, stdout=subprocess.PIPE)
+        except (IOError, OSError) as e:
+            self.fail_json(msg="Failed to run {}: {}".format(command[0], e))
+        try:
+            self.parsed_processes, self.total_processes = parse_ps_lines(
+                ps.stdout, self.output_parsed_processes, self.raw_output if self.output_ps_stdout_lines else None,
+                self.keep)
+        finally:
+            ps.stdout.close()
+            rc = ps.wait()
+        if rc != 0:
+            self.fail_json(msg="{} failed with return code {}".format(' '.join(command), rc))
 
-        self.parsed_processes = []
-        for proc in self.raw_processes:
-            with open("/tmp/john", "w") as f:
-                f.write(proc)
-
-            process = dict()
-            if re_ps.search(proc):
-                process['user'] = re_ps.search(proc).group('user')
-                process['pid'] = re_ps.search(proc).group('pid')
-                process['cpu_percentage'] = re_ps.search(proc).group('cpu')
-                process['memory_percentage'] = re_ps.search(proc).group('mem')
-                process['virtual_memory_size'] = re_ps.search(proc).group('vsz')
-                process['resident_size'] = re_ps.search(proc).group('rss')
-                process['teletype'] = re_ps.search(proc).group('tty')
-                process['stat'] = re_ps.search(proc).group('stat')
-                process['start'] = re_ps.search(proc).group('start')
-                process['time'] = re_ps.search(proc).group('time')
-                process['command'] = re_ps.search(proc).group('command')
-                self.parsed_processes.append(process)
+    def get_ppids(self, command):
+        # 'ps auxww' has no parent pid
+        rc, out, err = self.run_command(command)
+        if rc != 0:
+            self.fail_json(msg="{} failed with return code {}: {}".format(' '.join(command), rc, err))
+        ppids = parse_ppids(out.splitlines())
+        for p in self.parsed_processes:
+            p['ppid'] = ppids.get(p['pid'])
+
+    def read_proc(self):
+        try:
+            if self.sampler is not None:
+                self.parsed_processes, self.transient_processes, self.total_processes = self.sampler.processes(
+                    self.keep, not self.params['drop_kernel_threads'])
+            else:
+                self.parsed_processes, self.total_processes = ProcReader().processes(
+                    self.keep, not self.params['drop_kernel_threads'])
+        except (IOError, OSError) as e:
+            self.fail_json(msg="Unable to read processes from /proc: {}".format(e))
+        if self.output_ps_stdout_lines:
+            self.raw_output = [ps_line(p) for p in self.parsed_processes]
 
     def doDefault(self):
         # Do work
-        self.get_processes(['/bin/ps', 'auxww'])
+        backend = self.backend
+        if backend == 'auto':
+            backend = 'proc' if sys.platform.startswith('linux') and isfile('/proc/self/stat') else 'ps'
+        if self.params['samples'] > 1:
+            if backend != 'proc':
+                self.fail_json(msg="samples requires the proc backend")
+            if self.params['sample_window'] <= 0 or self.params['sample_cpu_budget'] <= 0:
+                self.fail_json(msg="sample_window and sample_cpu_budget must be greater than 0")
+            self.sampler = ProcSampler(self.params['samples'], self.params['sample_window'],
+                                       self.params['sample_cpu_budget'])
+        if backend == 'proc':
+            self.read_proc()
+        else:
+            ps = self.findCommand('ps')
+            self.get_processes([ps, 'auxww'])
+            if self.parsed_processes:
+                self.get_ppids([ps, '-e', '-o', 'pid=', '-o', 'ppid='])
 
         # Build output
         processes = dict()
@@ -114,10 +432,37 @@ class ProcessGatherer(FactGatherer):
             processes['ps_stdout_lines'] = self.raw_output
 
         if self.output_parsed_processes:
-            self.parse_process_data()
-            processes['total_running_processes'] = len(self.parsed_processes)
-            processes['processes'] = self.parsed_processes
-        self.exit_json(**{'ansible_facts': {'running_processes': processes}})
+            processes['total_running_processes'] = self.total_processes
+            if self.params['listening_ports']:
+                if not isdir('/proc/net'):
+                    self.fail_json(msg="listening_ports requires /proc")
+                sockets = SocketIndex(max_fds=self.params['max_fds'])
+                processes['listeners'] = sockets.join(self.parsed_processes)
+                if sockets.skipped:
+                    self.warn("{} processes with more than {} open files were not searched for listening sockets"
+                              .format(sockets.skipped, self.params['max_fds']))
+            if self.process_tree:
+                processes['children'] = process_children(self.parsed_processes)
+            if self.collapse_workers:
+                self.parsed_processes = collapse_workers(self.parsed_processes)
+            if self.typed_fields:
+                type_fields(self.parsed_processes)
+                type_fields(self.transient_processes)
+                for children in processes.get('children', dict()).values():
+                    children[:] = [int(c) for c in children]
+                for listener in processes.get('listeners', list()):
+                    listener['pids'] = [int(pid) for pid in listener['pids']]
+            if self.output_format == 'columns':
+                processes['columns'], processes['values'] = to_columns(self.parsed_processes)
+            else:
+                processes['processes'] = self.parsed_processes
+            if self.sampler is not None:
+                processes['transient_processes'] = self.transient_processes
+        result = {'ansible_facts': {'running_processes': processes}, 'backend': backend}
+        if self.sampler is not None:
+            result['sampling'] = dict(samples=self.sampler.taken, window=round(self.sampler.elapsed, 3),
+                                      cpu_seconds=round(self.sampler.cpu_seconds, 3))
+        self.exit_json(**result)
 
     def __init__(self, argument_spec, **kwargs):
         # Call the parent constructor
@@ -125,9 +470,20 @@ class ProcessGatherer(FactGatherer):
         # Extract the module params into class variables
         self.output_parsed_processes = self.params['output_parsed_processes']
         self.output_ps_stdout_lines = self.params['output_ps_stdout_lines']
+        self.backend = self.params['backend']
+        self.output_format = self.params['output_format']
+        self.process_tree = self.params['process_tree']
+        self.collapse_workers = self.params['collapse_workers']
+        self.typed_fields = self.params['typed_fields']
+        try:
+            self.keep = process_filter(self.params)
+        except re.error as e:
+            self.fail_json(msg="Invalid {}".format(e))
         # Set additional class variables
         self.raw_output = []
         self.parsed_processes = []
+        self.transient_processes = []
+        self.sampler = None
 
 
 
@@ -136,6 +492,22 @@ def main():
         dict(
             output_ps_stdout_lines=dict(type='bool', default=False, required=False),
             output_parsed_processes=dict(type='bool', default=True, required=False),
+            backend=dict(type='str', default='auto', choices=['auto', 'proc', 'ps'], required=False),
+            output_format=dict(type='str', default='rows', choices=['rows', 'columns'], required=False),
+            include_commands=dict(type='list', default=list(), required=False),
+            exclude_commands=dict(type='list', default=list(), required=False),
+            users=dict(type='list', default=list(), required=False),
+            min_rss=dict(type='int', default=0, required=False),
+            min_cpu=dict(type='float', default=0, required=False),
+            drop_kernel_threads=dict(type='bool', default=False, required=False),
+            process_tree=dict(type='bool', default=False, required=False),
+            collapse_workers=dict(type='bool', default=False, required=False),
+            samples=dict(type='int', default=1, required=False),
+            sample_window=dict(type='float', default=10, required=False),
+            sample_cpu_budget=dict(type='float', default=5, required=False),
+            typed_fields=dict(type='bool', default=False, required=False),
+            listening_ports=dict(type='bool', default=False, required=False),
+            max_fds=dict(type='int', default=4096, required=False),
         ),
         supports_check_mode=True,
     )
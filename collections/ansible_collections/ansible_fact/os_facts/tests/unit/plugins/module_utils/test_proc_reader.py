@@ -0,0 +1,48 @@
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import re
+
+import pytest
+
+from ansible_collections.ansible_fact.os_facts.plugins.module_utils.proc_reader import process_filter
+
+
+def filter_params(**params):
+    defaults = dict(include_commands=[], exclude_commands=[], users=[], min_rss=0, min_cpu=0,
+                    drop_kernel_threads=False)
+    defaults.update(params)
+    return defaults
+
+
+def process(command):
+    return dict(command=command, user='root', resident_size='1024', cpu_percentage='0.0', virtual_memory_size='2048')
+
+
+def test_include_inline_flag():
+    keep = process_filter(filter_params(include_commands=['(?i)HTTPD']))
+    assert keep(process('/usr/sbin/httpd -DFOREGROUND'))
+    assert not keep(process('/usr/sbin/sshd -D'))
+
+
+def test_include_backreference():
+    # each pattern keeps its own group numbers
+    keep = process_filter(filter_params(include_commands=['(b)x', '(a)\\1']))
+    assert keep(process('aa'))
+    assert keep(process('bx'))
+    assert not keep(process('ab'))
+
+
+def test_exclude_inline_flag_and_backreference():
+    keep = process_filter(filter_params(exclude_commands=['(?i)^KWORKER', r'(\d)\1']))
+    assert not keep(process('kworker/0:1'))
+    assert not keep(process('/opt/app --port 8800'))
+    assert keep(process('/opt/app --port 8080'))
+
+
+def test_invalid_pattern_is_named():
+    with pytest.raises(re.error) as e:
+        process_filter(filter_params(include_commands=['httpd', '(foo']))
+    assert "include_commands regular expression '(foo'" in str(e.value)
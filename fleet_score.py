@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+# Re-scores application signatures for a whole fleet on the controller,
+# using facts already collected by the Discovery playbook (i.e. a jsonfile
+# fact cache) and a catalog compiled by the signature_catalog module.
+#
+# The command lines, packages, listeners... of all hosts are deduplicated
+# and each distinct item is matched against the signature features once.
+# Every category is then encoded as sparse hosts x items, items x features
+# and features x signatures matrices, so the counters of all hosts and
+# signatures are matrix products per category and the thresholds are applied
+# to whole matrices.  The threshold semantics are those of
+# library/application_id.py.
+#
+# Paths can not be checked from the controller.  They are taken from the
+# application_signature_paths fact returned by application_id in batch mode,
+# which covers every path of the catalog the host was scored with.  A
+# signature with a paths threshold and a path that was not probed on a host
+# (a signature added or edited since) is not scored for that host, it is
+# reported as unscored and left out of --verify.
+#
+# Usage:
+#   ./fleet_score.py --catalog signature_catalog.json /path/to/fact_cache > discovered_apps.json
+
+import argparse
+import json
+import os
+import sys
+import time
+
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+FACT_KEYS = ['services', 'running_processes', 'packages', 'tcp_listen', 'udp_listen', 'local_users',
+             'local_groups', 'application_signature_paths']
+
+
+def load_application_id():
+    # the scoring primitives live in the application_id module
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'library', 'application_id.py')
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location('application_id', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    except ImportError:
+        import imp
+        return imp.load_source('application_id', path)
+
+
+def host_facts(facts):
+    # builds the application_id fact subset from cached host facts
+    subset = dict()
+    for key in FACT_KEYS:
+        if key in facts:
+            subset[key] = facts[key]
+        elif 'ansible_' + key in facts:
+            subset[key] = facts['ansible_' + key]
+    if 'fact_subset' in facts:
+        subset.update(facts['fact_subset'])
+    return subset
+
+
+def load_facts(sources):
+    # a directory is read as a jsonfile fact cache (one file per host), a
+    # file as a dictionary of host names to facts
+    hosts = dict()
+    for source in sources:
+        if os.path.isdir(source):
+            for name in sorted(os.listdir(source)):
+                path = os.path.join(source, name)
+                if os.path.isfile(path):
+                    with open(path) as f:
+                        hosts[name] = host_facts(json.load(f))
+        else:
+            with open(source) as f:
+                for host, facts in json.load(f).items():
+                    hosts[host] = host_facts(facts)
+    return hosts
+
+
+class SparseRows(object):
+    # Compressed sparse rows matrix, only what is needed to multiply a
+    # matrix given as coordinates by it
+    def __init__(self, rows, ncols):
+        # rows is a list of dictionaries of column to value
+        self.shape = (len(rows), ncols)
+        self.indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        self.indptr[1:] = np.cumsum([len(r) for r in rows])
+        self.indices = np.array([j for r in rows for j in sorted(r)], dtype=np.int64)
+        self.data = np.array([r[j] for r in rows for j in sorted(r)], dtype=np.int64)
+
+    def multiply(self, rows, cols, values):
+        # product of the (rows, cols, values) coordinates matrix with this
+        # one, as coordinates where a cell may appear more than once
+        counts = self.indptr[cols + 1] - self.indptr[cols]
+        offsets = np.cumsum(counts) - counts
+        positions = np.repeat(self.indptr[cols] - offsets, counts) + np.arange(counts.sum())
+        return (np.repeat(rows, counts), self.indices[positions],
+                np.repeat(values, counts) * self.data[positions])
+
+
+def sum_duplicates(rows, cols, values, ncols):
+    cells, inverse = np.unique(rows * ncols + cols, return_inverse=True)
+    return cells // ncols, cells % ncols, np.bincount(inverse, weights=values).astype(np.int64)
+
+
+class FleetScorer(object):
+    def __init__(self, aid, signatures, process_hits='process'):
+        self.aid = aid
+        self.signatures = signatures
+        self.process_hits = process_hits
+
+        # sparse features x signatures matrix per category, a feature
+        # referenced twice by a signature counts twice like in application_id
+        self.features = dict()
+        self.weights = dict()
+        for category in aid.SCORE_CATEGORIES:
+            vocab = dict()
+            rows = list()
+            for j, sig in enumerate(signatures):
+                for item in sig[category]:
+                    i = vocab.setdefault(self.feature_key(category, item), len(vocab))
+                    if i == len(rows):
+                        rows.append(dict())
+                    rows[i][j] = rows[i].get(j, 0) + 1
+            self.features[category] = vocab
+            self.weights[category] = SparseRows(rows, len(signatures))
+        self.thresholds = dict((c, np.array([sig['scores'][c] for sig in signatures], dtype=np.float32))
+                               for c in aid.SCORE_CATEGORIES)
+        self.matcher = aid.ProcessMatcher(list(self.features['processes']))
+        self.versioned_packages = dict()
+        for key, j in self.features['packages'].items():
+            if isinstance(key, tuple):
+                self.versioned_packages.setdefault(key[0], list()).append((key[1], j))
+
+    def feature_key(self, category, item):
+        if category == 'ports':
+            return tuple(sorted(item.items()))
+        if category == 'packages' and isinstance(item, dict):
+            # versioned package, keyed by its constraints
+            return (item['name'], tuple(item['constraints']))
+        if category == 'processes':
+            return str(item)
+        return item
+
+    def host_items(self, facts):
+        # (category, item, weight) for everything of a host that can match a
+        # feature, read like FactIndex reads it
+        for category, key, field in [('services', 'services', None), ('users', 'local_users', 'user'),
+                                     ('groups', 'local_groups', 'group')]:
+            if field is None:
+                items = [k for k, v in (facts.get(key) or {}).items() if v is not None]
+            else:
+                items = [e[field] for e in facts.get(key) or [] if e.get(field) is not None]
+            for item in items:
+                yield category, item, 1
+        for name, installed in (facts.get('packages') or {}).items():
+            if installed is None:
+                continue
+            yield 'packages', name, 1
+            if name in self.versioned_packages:
+                for pkg in installed:
+                    key = self.aid.package_version_key(pkg)
+                    if key is not None:
+                        yield 'packages', (name, key), 1
+
+        running_processes = facts.get('running_processes') or {}
+        commands = self.aid.process_commands(running_processes)
+        workers = self.aid.process_workers(running_processes) or [1] * len(commands)
+        for command, weight in zip(commands, workers):
+            if command is not None:
+                yield 'processes', str(command), int(weight)
+
+        for protocol in self.aid.LISTEN_PROTOCOLS:
+            for l in facts.get('%s_listen' % protocol) or []:
+                try:
+                    port = int(l['port'])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                yield 'ports', (protocol, port, str(l.get('address')), l.get('name')), 1
+
+        for path, found in (facts.get('application_signature_paths') or {}).items():
+            if found:
+                yield 'paths', path, 1
+
+    def match(self, category, item):
+        # features an item (a command line, an installed package version, a
+        # listener...) matches, as a dictionary of feature to 1
+        vocab = self.features[category]
+        if category == 'processes':
+            return dict((vocab[self.matcher.patterns[i]], 1) for i in self.matcher.search(item))
+        if category == 'ports':
+            protocol, number, address, name = item
+            found = dict()
+            for key, j in vocab.items():
+                port = dict(key)
+                if port['protocol'] not in (None, protocol) or not port['low'] <= number <= port['high']:
+                    continue
+                if port['address'] is not None and address != str(port['address']):
+                    continue
+                if port['process'] is not None and name != port['process']:
+                    continue
+                found[j] = 1
+            return found
+        if category == 'packages' and isinstance(item, tuple):
+            return dict((j, 1) for constraints, j in self.versioned_packages[item[0]]
+                        if self.aid.satisfies(item[1], constraints))
+        return {vocab[item]: 1} if item in vocab else {}
+
+    def encode(self, hosts):
+        # sparse hosts x features matrix per category, as coordinates.  The
+        # items of every host are deduplicated across the fleet, and each
+        # distinct item is matched against the features once
+        names = sorted(hosts)
+        items = dict((c, dict()) for c in self.aid.SCORE_CATEGORIES)
+        item_features = dict((c, list()) for c in self.aid.SCORE_CATEGORIES)
+        entries = dict((c, (list(), list(), list())) for c in self.aid.SCORE_CATEGORIES)
+        for i, host in enumerate(names):
+            for category, item, weight in self.host_items(hosts[host]):
+                k = items[category].get(item, -1)
+                if k == -1:
+                    # items matching no feature are left out of the matrices
+                    found = self.match(category, item)
+                    k = len(item_features[category]) if found else None
+                    if found:
+                        item_features[category].append(found)
+                    items[category][item] = k
+                if k is not None:
+                    rows, cols, values = entries[category]
+                    rows.append(i)
+                    cols.append(k)
+                    values.append(weight)
+
+        matrices = dict()
+        for category in self.aid.SCORE_CATEGORIES:
+            rows, cols, values = [np.array(e, dtype=np.int64) for e in entries[category]]
+            features = SparseRows(item_features[category], len(self.features[category]))
+            rows, cols, values = sum_duplicates(*features.multiply(rows, cols, values),
+                                                ncols=len(self.features[category]))
+            if category != 'processes' or self.process_hits == 'pattern':
+                # every other category counts a feature once per host
+                values = np.minimum(values, 1)
+            matrices[category] = (rows, cols, values)
+        return names, matrices
+
+    def unprobed(self, names, hosts):
+        # hosts x signatures mask of the signatures with a paths threshold
+        # and a path missing from the application_signature_paths fact
+        vocab = self.features['paths']
+        rows = list()
+        cols = list()
+        for i, host in enumerate(names):
+            probed = hosts[host].get('application_signature_paths') or {}
+            for path, j in vocab.items():
+                if path not in probed:
+                    rows.append(i)
+                    cols.append(j)
+        rows, cols, values = self.weights['paths'].multiply(np.array(rows, dtype=np.int64),
+                                                            np.array(cols, dtype=np.int64),
+                                                            np.ones(len(rows), dtype=np.int64))
+        mask = np.zeros((len(names), len(self.signatures)), dtype=bool)
+        mask[rows, cols] = True
+        return mask & (self.thresholds['paths'] > 0)
+
+    def score(self, hosts):
+        names, matrices = self.encode(hosts)
+        shape = (len(names), len(self.signatures))
+        identified = np.ones(shape, dtype=bool)
+        counters = dict()
+        for category in self.aid.SCORE_CATEGORIES:
+            rows, cols, values = self.weights[category].multiply(*matrices[category])
+            counts = np.bincount(rows * shape[1] + cols, weights=values,
+                                 minlength=shape[0] * shape[1]).reshape(shape)
+            counters[category] = counts
+            identified &= counts >= self.thresholds[category]
+        unscored = self.unprobed(names, hosts)
+        identified &= ~unscored
+        return names, identified, unscored, counters
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score application signatures for every host in a fact cache')
+    parser.add_argument('facts', nargs='+', help='jsonfile fact cache directory, or JSON file of host facts')
+    parser.add_argument('--catalog', required=True, help='catalog written by the signature_catalog module')
+    parser.add_argument('--process-hits', default='process', choices=['process', 'pattern'])
+    parser.add_argument('--counters', action='store_true', help='include per signature counters in the output')
+    parser.add_argument('--verify', action='store_true',
+                        help='also score every host with application_id and report differences')
+    args = parser.parse_args()
+
+    if not HAS_NUMPY:
+        sys.exit('fleet_score.py requires the numpy python library')
+
+    aid = load_application_id()
+    with open(args.catalog) as f:
+        catalog = json.load(f)
+    signatures = [aid.normalize_signature(s) for s in catalog['signatures']]
+    hosts = load_facts(args.facts)
+
+    start = time.time()
+    scorer = FleetScorer(aid, signatures, args.process_hits)
+    names, identified, unscored, counters = scorer.score(hosts)
+    elapsed = time.time() - start
+
+    output = dict()
+    for i, host in enumerate(names):
+        discovered_apps = list()
+        for j in np.flatnonzero(identified[i]):
+            if signatures[j]['application'] not in discovered_apps:
+                discovered_apps.append(signatures[j]['application'])
+        output[host] = dict(discovered_apps=discovered_apps)
+        unscored_apps = list()
+        for j in np.flatnonzero(unscored[i]):
+            if signatures[j]['application'] not in discovered_apps + unscored_apps:
+                unscored_apps.append(signatures[j]['application'])
+        if unscored_apps:
+            output[host]['unscored_apps'] = unscored_apps
+        if args.counters:
+            output[host]['counters'] = [
+                dict((aid.COUNTERS[c], int(counters[c][i, j])) for c in aid.SCORE_CATEGORIES)
+                for j in range(len(signatures))]
+    json.dump(output, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+    sys.stderr.write('Scored %d signatures for %d hosts in %.2fs\n' % (len(signatures), len(names), elapsed))
+    if unscored.any():
+        sys.stderr.write('Warning: %d signatures not scored on %d hosts, their paths were not probed, '
+                         'run application_id with this catalog first\n'
+                         % (np.count_nonzero(unscored.any(axis=0)), np.count_nonzero(unscored.any(axis=1))))
+
+    if args.verify:
+        mismatches = 0
+        for i, host in enumerate(names):
+            facts = hosts[host]
+            scorer = aid.SignatureScorer(aid.FactIndex(facts), args.process_hits, short_circuit=False,
+                                         path_results=facts.get('application_signature_paths') or dict())
+            expected = [r['identified'] and not skipped
+                        for r, skipped in zip(scorer.score(signatures), unscored[i])]
+            if expected != list(identified[i]):
+                mismatches += 1
+                sys.stderr.write('Mismatch for host %s\n' % host)
+        sys.stderr.write('Verified %d hosts, %d mismatches\n' % (len(names), mismatches))
+        if mismatches:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -46,6 +46,8 @@ groups:
 packages:
     description:
         - List of packages to check when identifying a running application.
+        - 'A package name can be followed by comma separated version constraints using ==, !=, >=, <=, > or <, i.e. C(samba >= 4.0, < 5) or C(openssl-libs >= 1:1.0.2k-16).  A constraint without a release only compares the epoch and version.  An item can also be a dictionary with C(name) and C(version) keys, i.e. C({name: samba, version: ">= 4.0, < 5"}).'
+        - Versions are compared following the rpm version comparison rules, including ~ for pre-releases, against every installed version of the package in the packages fact.
     type: list
     default: []
     required: True
@@ -57,13 +59,17 @@ paths:
     required: True
 ports:
     description:
-        - List of listening ports to check when identifying a running application.
+        - List of listening ports to check when identifying a running application, matched against the tcp_listen and udp_listen facts.
+        - Each item is a port number, a port range such as C(8000-8100), either optionally prefixed with a protocol such as C(tcp/80), or a dictionary with C(port), and optional C(protocol), C(address) and C(process) (name of the listening process) keys.
+        - Every item that matches at least one listener counts as one hit.
     type: list
     default: []
     required: True
 processes:
     description:
         - List of processes to check when identifying a running application.  Can be a partial process name to keep generic across OS platforms.
+        - A pattern prefixed with C(re:) is a regular expression searched in the command line (anchor it with ^), C(glob:) a shell wildcard matched against the whole command line and C(exe:) the exact basename of the executable.
+        - Every command line is scanned once for all the substrings, and for the longest literal each C(re:) and C(glob:) pattern requires (i.e. C(/usr/sbin/httpd) in C(re:^/usr/sbin/httpd\\b)); a pattern is only tested against the command lines holding its literal.  Patterns without a required literal (i.e. case insensitive ones, or C(re:\\d+)) are tested against every command line, one at a time.
     type: list
     default: []
     required: True
@@ -76,9 +82,10 @@ services:
 facts:
     description:
         - Dictionary of collected ansible_facts to perform the application identification against.  The expected format is based on ansible-fact and Ansible Migration Factory's discovery process.
+        - Required unless probe_paths is set.
     type: dictionary
     default: {}
-    required: True
+    required: False
 scores:
     description:
         - Dictionary of scores required to properly identify the running application.  Each category requires an integer that represents the minimum count that will satisfy a >= evaluation.
@@ -134,6 +141,74 @@ discovered_apps:
     type: list
     default: []
     required: True
+process_hits:
+    description:
+        - How process matches are counted towards the processes score.
+        - C(process) counts one hit for every running process a pattern is found in.
+        - C(pattern) counts one hit for every pattern found in at least one running process.
+    type: string
+    default: process
+    choices: [process, pattern]
+    required: False
+path_timeout:
+    description:
+        - Seconds to wait for a single path existence check before treating the path as missing, so a hung NFS mount can not stall discovery.  Set to 0 to check paths without a timeout.
+    type: float
+    default: 5.0
+    required: False
+path_scandir:
+    description:
+        - Resolve paths sharing a parent directory with a single listing of that directory, instead of checking every path separately.
+    type: bool
+    default: False
+    required: False
+short_circuit:
+    description:
+        - Evaluate the categories of a signature from the cheapest (services, packages, users, groups) to the most expensive (ports, processes, paths), and stop evaluating a signature as soon as one of its scores can not be met.  Counters of the categories that were not evaluated are returned as 0 and listed in skipped_categories.
+        - Set to False to always evaluate every category.
+    type: bool
+    default: True
+    required: False
+explain:
+    description:
+        - Return signature_explain, with the wall time spent per category for every signature, the items that matched and the score that was not met, along with the time spent in the shared process scan and path probe.
+    type: bool
+    default: False
+    required: False
+scoring:
+    description:
+        - Where the facts are scored when the module is run through the application_id action plugin.  With C(controller), every category except paths is scored on the Ansible controller and the module is only executed on the host to check the paths, if any.  With C(remote), the module is executed on the host as usual.
+    type: string
+    default: controller
+    choices: [controller, remote]
+    required: False
+memo_dir:
+    description:
+        - Directory on the Ansible controller to memoize results in when scoring on the controller.  Results are keyed by a hash of the facts scoring looks at, the signatures and the options, so hosts cloned from the same image reuse the result of the first one (after checking their paths).  The key includes a hash of this module, and results are not memoized when explain is set.  Not set disables memoization.
+    type: path
+    required: False
+memo_size:
+    description:
+        - Maximum number of results kept in memo_dir, the least recently used results are removed first.
+    type: int
+    default: 4096
+    required: False
+state_dir:
+    description:
+        - Directory on the Ansible controller to keep the last result of every host in when scoring on the controller.  On the next run only the signatures that reference a fact category whose hash changed, a path whose existence changed, or that changed themselves are scored again, the other results are carried forward.  The last results are discarded when the options or this module change.  Not set disables incremental scoring.
+    type: path
+    required: False
+probe_paths:
+    description:
+        - Only check the existence of these paths and return them as path_results.  Used by the application_id action plugin.
+    type: list
+    required: False
+signatures:
+    description:
+        - List of application signature definitions to score in a single module execution (batch mode).  When set, the per-signature options (application, users, groups, paths, packages, ports, processes, services and scores) are ignored, and an empty list identifies nothing.
+        - Each list item is either the contents of an application signature role's defaults/main.yml (the amf_as_* variables), or a dictionary using this module's option names.
+    type: list
+    required: False
 
 author:
     - Andrew J. Huffman (@ahuffman)
@@ -170,202 +245,1194 @@ EXAMPLES = '''
       ports: 0
       processes: 3
       services: 0
+
+# Score every application signature role in one execution
+- name: "Identify applications"
+  application_id:
+    facts: "{{ fact_subset }}"
+    signatures:
+      - "{{ lookup('file', 'roles/amf-application-signature-samba/defaults/main.yml') | from_yaml }}"
+      - "{{ lookup('file', 'roles/amf-application-signature-iscsi-target/defaults/main.yml') | from_yaml }}"
+    discovered_apps: "{{ ansible_facts.discovered_apps | default([]) }}"
 '''
 
 RETURN = '''
 ansible_facts['discovered_apps']:
   - name: "Oracle Database"
     desc: "Hosts identified as Oracle Database Servers"
+ansible_facts['application_signature_paths']:
+  description: Existence of every path of the signatures, checked whatever the short-circuit discarded, only returned in batch mode.  Used to re-score hosts on the controller with fleet_score.py.
+  returned: when signatures is set
+  type: dict
+  sample:
+    "/usr/sbin/httpd": True
+path_probe:
+  description: Number of distinct paths checked and paths whose check timed out, only returned in batch mode
+  returned: when signatures is set
+  type: dict
+  sample:
+    probed: 12
+    timed_out:
+      - "/nfs/app/bin"
+memo:
+  description: Whether the result was reused from memo_dir, and the hit and miss counts of memo_dir
+  returned: when memo_dir is set and scoring is controller
+  type: dict
+  sample:
+    hit: True
+    hits: 241
+    misses: 59
+    hit_rate: 0.8033
+incremental:
+  description: Fact categories and paths that changed since the last run, and how many signatures were scored again or carried forward
+  returned: when state_dir is set and scoring is controller
+  type: dict
+  sample:
+    changed_categories: ["packages"]
+    changed_paths: []
+    rescored: 4
+    carried: 296
+signature_explain:
+  description: Per signature timings (in seconds) and match details
+  returned: when explain is True
+  type: dict
+  sample:
+    stages:
+      processes: 0.004121
+      paths: 0.000215
+      total: 0.006032
+    signatures:
+      - name: "Samba"
+        time: 0.000041
+        timings:
+          services: 0.000003
+          packages: 0.000004
+        matched:
+          services: []
+          packages: []
+        failed:
+          category: packages
+          required: 1
+          count: 0
+          evaluated: True
+signature_results:
+  description: Per signature counters, only returned in batch mode
+  returned: when signatures is set
+  type: list
+  sample:
+    - name: "Samba"
+      tag_name: "samba_server"
+      identified: True
+      counters:
+        user_count: 0
+        group_count: 0
+        svc_count: 0
+        port_count: 0
+        proc_count: 2
+        pkg_count: 1
+        path_count: 0
+      skipped_categories: []
 '''
 
+
 from ansible.module_utils.basic import AnsibleModule
+from bisect import bisect_left
+from collections import deque
 from os.path import exists
+import fnmatch
+import hashlib
+import json
+import operator
+import os
+import re
+import threading
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    # Python < 3.11
+    import sre_parse
+import time
 
-def main():
-    module_args = dict(
-        services=dict(
-            type='list',
-            default=list(),
-            required=False
-        ),
-        users=dict(
-            type='list',
-            default=list(),
-            required=False
-        ),
-        groups=dict(
-            type='list',
-            default=list(),
-            required=False
-        ),
-        paths=dict(
-            type='list',
-            default=list(),
-            required=False
-        ),
-        packages=dict(
-            type='list',
-            default=list(),
-            required=False
-        ),
-        processes=dict(
-            type='list',
-            default=list(),
-            required=False
-        ),
-        ports=dict(
-            type='list',
-            default=list(),
-            required=False
-        ),
-        application=dict(
-            type='dict',
-            default=dict(
-                name="",
-                desc=""
-            ),
-            required=False
-        ),
-        scores=dict(
-            type='dict',
-            default=dict(
-                users=0,
-                groups=0,
-                services=0,
-                paths=0,
-                packages=0,
-                processes=0,
-                ports=0
-            ),
-            required=False
+SCORE_CATEGORIES = ['users', 'groups', 'services', 'paths', 'packages', 'processes', 'ports']
+# categories in the order they are evaluated, cheapest first
+COST_ORDER = ['services', 'packages', 'users', 'groups', 'ports', 'processes', 'paths']
+COUNTERS = dict(users='user_count', groups='group_count', services='svc_count', paths='path_count',
+                packages='pkg_count', processes='proc_count', ports='port_count')
+# the FactIndex.fingerprints() category each score category is counted from
+FACT_CATEGORIES = dict(users='users', groups='groups', services='services', packages='packages',
+                       processes='processes', ports='listeners')
+LISTEN_PROTOCOLS = ['tcp', 'udp']
+PROCESS_PATTERN_KINDS = ['re', 'glob', 'exe']
+
+VERSION_OPERATORS = {
+    '==': operator.eq,
+    '=': operator.eq,
+    '!=': operator.ne,
+    '>=': operator.ge,
+    '<=': operator.le,
+    '>': operator.gt,
+    '<': operator.lt,
+}
+VERSION_SEGMENT = re.compile(r'~|\^|[0-9]+|[a-zA-Z]+')
+VERSION_CONSTRAINT = re.compile(r'^\s*(==|=|!=|>=|<=|>|<)?\s*([^<>=!\s]\S*)\s*$')
+PACKAGE_CONSTRAINT = re.compile(r'^\s*([^<>=!\s]+)\s*(.*)$')
+
+# items of a parsed regular expression whose content every match contains
+# (ATOMIC_GROUP is Python 3.11+)
+REGEX_GROUPS = [g for g in [sre_parse.SUBPATTERN, getattr(sre_parse, 'ATOMIC_GROUP', None)] if g is not None]
+REGEX_REPEATS = [sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, 'POSSESSIVE_REPEAT', None)]
+
+_process_matchers = dict()
+_process_regexes = dict()
+
+
+def parse_port(spec):
+    # Returns a port check as a dictionary with protocol, low, high,
+    # address and process keys, None meaning any
+    if isinstance(spec, dict):
+        port = dict(spec)
+    else:
+        port = dict(port=spec)
+    protocol = port.get('protocol')
+    ports = str(port.get('port', '')).strip()
+    if '/' in ports:
+        protocol, ports = ports.split('/', 1)
+    if protocol is not None:
+        protocol = str(protocol).lower()
+        if protocol not in LISTEN_PROTOCOLS:
+            raise ValueError("unsupported port protocol '%s'" % protocol)
+    if '-' in ports:
+        low, high = ports.split('-', 1)
+    else:
+        low = high = ports
+    try:
+        low = int(low)
+        high = int(high)
+    except ValueError:
+        raise ValueError("invalid port '%s'" % ports)
+    if low > high:
+        raise ValueError("invalid port range '%s'" % ports)
+    return dict(
+        protocol=protocol,
+        low=low,
+        high=high,
+        address=port.get('address'),
+        process=port.get('process')
+    )
+
+
+def check_process_pattern(pattern):
+    compile_process_pattern(pattern)
+    return pattern
+
+
+def normalize_signature(sig):
+    # Accepts either an application signature role's defaults (amf_as_*) or
+    # a dictionary keyed with this module's option names
+    if 'amf_as_discovered_app' in sig or 'amf_as_scores' in sig:
+        user_group = sig.get('amf_as_user_group') or dict()
+        sig = dict(
+            application=sig.get('amf_as_discovered_app'),
+            users=user_group.get('users'),
+            groups=user_group.get('groups'),
+            services=sig.get('amf_as_services'),
+            paths=sig.get('amf_as_paths'),
+            packages=sig.get('amf_as_packages'),
+            processes=sig.get('amf_as_processes'),
+            ports=sig.get('amf_as_ports'),
+            scores=sig.get('amf_as_scores')
+        )
+
+    scores = sig.get('scores') or dict()
+    return dict(
+        application=sig.get('application') or dict(name="", desc=""),
+        users=list(sig.get('users') or []),
+        groups=list(sig.get('groups') or []),
+        services=list(sig.get('services') or []),
+        paths=list(sig.get('paths') or []),
+        packages=[parse_package(p) for p in sig.get('packages') or []],
+        processes=[check_process_pattern(p) for p in sig.get('processes') or []],
+        ports=[p if isinstance(p, dict) and 'low' in p else parse_port(p) for p in sig.get('ports') or []],
+        scores=dict((c, int(scores.get(c) or 0)) for c in SCORE_CATEGORIES)
+    )
+
+
+def version_segments(version):
+    # Comparable key for a version or release string, following rpm's
+    # rpmvercmp: separators are ignored, numeric segments sort above alpha
+    # segments, ~ sorts below the end of the string and ^ above it
+    key = list()
+    for segment in VERSION_SEGMENT.findall(version or ''):
+        if segment == '~':
+            key.append((-1,))
+        elif segment == '^':
+            key.append((1,))
+        elif segment.isdigit():
+            key.append((3, int(segment)))
+        else:
+            key.append((2, segment))
+    key.append((0,))
+    return tuple(key)
+
+
+def split_version(version):
+    # "[epoch:]version[-release]" to (epoch, version, release)
+    version = str(version).strip()
+    epoch = 0
+    release = None
+    if ':' in version:
+        epoch, version = version.split(':', 1)
+        epoch = int(epoch)
+    if '-' in version:
+        version, release = version.rsplit('-', 1)
+    return epoch, version, release
+
+
+def version_key(epoch, version, release):
+    return (int(epoch or 0), version_segments(version), version_segments(release) if release is not None else None)
+
+
+def package_version_key(pkg):
+    # version key of one installed package entry, None without a version
+    if not isinstance(pkg, dict) or not pkg.get('version'):
+        return None
+    try:
+        if 'release' in pkg:
+            epoch, version, release = pkg.get('epoch'), str(pkg['version']), pkg.get('release')
+        else:
+            # dpkg style version with the epoch and revision included
+            epoch, version, release = split_version(pkg['version'])
+        return version_key(epoch, version, str(release) if release is not None else '')
+    except (TypeError, ValueError):
+        # malformed epoch, treated like an entry without a version
+        return None
+
+
+def satisfies(installed, constraints):
+    # a constraint without a release compares the epoch and version only
+    for op, wanted in constraints:
+        have = installed if wanted[2] is not None else installed[:2] + (None,)
+        if not op(have, wanted):
+            return False
+    return True
+
+
+def parse_package(spec):
+    # Returns a plain package name, or a dictionary with the name and the
+    # parsed version constraints as (operator, version key) pairs
+    if isinstance(spec, dict):
+        if 'constraints' in spec:
+            return spec
+        name = str(spec.get('name', '')).strip()
+        constraints = str(spec.get('version') or '')
+    else:
+        m = PACKAGE_CONSTRAINT.match(str(spec))
+        name = m.group(1).strip() if m else ''
+        constraints = m.group(2) if m else ''
+    if not name:
+        raise ValueError("invalid package '%s'" % spec)
+    if not constraints.strip():
+        return name
+
+    parsed = list()
+    for c in constraints.split(','):
+        m = VERSION_CONSTRAINT.match(c)
+        if m is None:
+            raise ValueError("invalid version constraint '%s' for package %s" % (c.strip(), name))
+        op = m.group(1) or '=='
+        try:
+            parsed.append((VERSION_OPERATORS[op], version_key(*split_version(m.group(2)))))
+        except ValueError:
+            raise ValueError("invalid version '%s' for package %s" % (m.group(2), name))
+    return dict(name=name, spec=spec, constraints=parsed)
+
+
+def process_commands(running_processes):
+    # the command of every process, running_processes may be returned by
+    # process_facts as rows or as columns.  The processes sampling saw start
+    # and exit come last
+    transient = [p.get('command') for p in running_processes.get('transient_processes') or []]
+    columns = running_processes.get('columns')
+    if columns is None:
+        return [p.get('command') for p in running_processes.get('processes') or []] + transient
+    values = (running_processes.get('values') or {}).get('command')
+    if values is not None:
+        return [values[i] for i in columns.get('command') or []] + transient
+    return list(columns.get('command') or []) + transient
+
+
+def process_workers(running_processes):
+    # the number of processes every entry of process_commands stands for,
+    # None when process_facts did not collapse workers
+    columns = running_processes.get('columns')
+    if columns is None:
+        workers = [p.get('workers') for p in running_processes.get('processes') or []]
+    else:
+        workers = list(columns.get('workers') or [])
+    if not workers or all(w is None for w in workers):
+        return None
+    return [w or 1 for w in workers] + [1] * len(running_processes.get('transient_processes') or [])
+
+
+class FactIndex(object):
+    # Lookup structures built once per host from the collected facts, so
+    # every signature scored against the host is a set or dict lookup
+    def __init__(self, facts):
+        self.services = set(k for k, v in (facts.get('services') or {}).items() if v is not None)
+        self.package_facts = facts.get('packages') or {}
+        self.packages = set(k for k, v in self.package_facts.items() if v is not None)
+        self.package_keys = dict()
+        self.users = set(u['user'] for u in facts.get('local_users') or [] if u.get('user') is not None)
+        self.groups = set(g['group'] for g in facts.get('local_groups') or [] if g.get('group') is not None)
+
+        running_processes = facts.get('running_processes') or {}
+        commands = process_commands(running_processes)
+        workers = process_workers(running_processes)
+        if workers is None:
+            self.commands = [str(c) for c in commands if c is not None]
+            self.command_weights = None
+        else:
+            # collapsed workers count as many processes
+            pairs = [(str(c), int(w)) for c, w in zip(commands, workers) if c is not None]
+            self.commands = [c for c, w in pairs]
+            self.command_weights = [w for c, w in pairs]
+
+        # listeners keyed by (protocol, port) and (protocol, port, address),
+        # plus sorted ports per protocol for range checks
+        self.listeners = dict()
+        self.listener_addresses = set()
+        self.listener_ports = dict((p, list()) for p in LISTEN_PROTOCOLS)
+        for protocol in LISTEN_PROTOCOLS:
+            for l in facts.get('%s_listen' % protocol) or []:
+                try:
+                    key = (protocol, int(l['port']))
+                except (KeyError, TypeError, ValueError):
+                    continue
+                if key not in self.listeners:
+                    self.listeners[key] = list()
+                    self.listener_ports[protocol].append(key[1])
+                self.listeners[key].append(l)
+                self.listener_addresses.add(key + (str(l.get('address')),))
+        for protocol in LISTEN_PROTOCOLS:
+            self.listener_ports[protocol].sort()
+
+    def fingerprints(self):
+        # Stable hash per fact category of exactly what scoring looks at,
+        # so hosts (or runs) with equal hashes score the same
+        packages = dict()
+        for name in self.packages:
+            packages[name] = sorted(
+                [str(p.get('epoch')), str(p.get('version')), str(p.get('release'))] if isinstance(p, dict) else [str(p)]
+                for p in self.package_facts[name] or [])
+        listeners = list()
+        for (protocol, port), entries in self.listeners.items():
+            for l in entries:
+                listeners.append([protocol, port, str(l.get('address')), str(l.get('name'))])
+        categories = dict(
+            services=sorted(self.services),
+            packages=packages,
+            processes=sorted(self.commands) if self.command_weights is None else
+            sorted(zip(self.commands, self.command_weights)),
+            users=sorted(self.users),
+            groups=sorted(self.groups),
+            listeners=sorted(listeners)
+        )
+        return dict((c, hashlib.sha1(json.dumps(v, sort_keys=True).encode('utf-8')).hexdigest())
+                    for c, v in categories.items())
+
+    def fingerprint(self):
+        return hashlib.sha1(json.dumps(self.fingerprints(), sort_keys=True).encode('utf-8')).hexdigest()
+
+    def installed_versions(self, name):
+        # version keys of every installed version of a package, parsed once
+        keys = self.package_keys.get(name)
+        if keys is None:
+            keys = list()
+            for pkg in self.package_facts.get(name) or []:
+                key = package_version_key(pkg)
+                if key is not None:
+                    keys.append(key)
+            self.package_keys[name] = keys
+        return keys
+
+    def has_package(self, package):
+        if not isinstance(package, dict):
+            return package in self.packages
+        if package['name'] not in self.packages:
+            return False
+        for installed in self.installed_versions(package['name']):
+            if satisfies(installed, package['constraints']):
+                return True
+        return False
+
+    def has_listener(self, protocol, port, address=None, process=None):
+        if address is not None and (protocol, port, str(address)) not in self.listener_addresses:
+            return False
+        listeners = self.listeners.get((protocol, port))
+        if not listeners:
+            return False
+        if process is None:
+            return True
+        for l in listeners:
+            if l.get('name') == process and (address is None or str(l.get('address')) == str(address)):
+                return True
+        return False
+
+    def match_port(self, port):
+        protocols = LISTEN_PROTOCOLS if port['protocol'] is None else [port['protocol']]
+        for protocol in protocols:
+            if port['low'] == port['high']:
+                if self.has_listener(protocol, port['low'], port['address'], port['process']):
+                    return True
+                continue
+            ports = self.listener_ports[protocol]
+            i = bisect_left(ports, port['low'])
+            while i < len(ports) and ports[i] <= port['high']:
+                if self.has_listener(protocol, ports[i], port['address'], port['process']):
+                    return True
+                i += 1
+        return False
+
+
+class AhoCorasick(object):
+    # Aho-Corasick automaton over a list of substrings, so a text is
+    # scanned once for all of them
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self.goto = [dict()]
+        self.fail = [0]
+        self.out = [()]
+
+        for i, p in enumerate(patterns):
+            node = 0
+            for c in p:
+                nxt = self.goto[node].get(c)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto.append(dict())
+                    self.fail.append(0)
+                    self.out.append(())
+                    self.goto[node][c] = nxt
+                node = nxt
+            self.out[node] = self.out[node] + (i,)
+
+        # breadth first walk to set failure links and merge outputs, the
+        # root's children always fail back to the root
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for c, nxt in self.goto[node].items():
+                queue.append(nxt)
+                f = self.fail[node]
+                while f and c not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(c, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def search(self, text):
+        # indexes of the patterns found in text
+        found = set(self.out[0])
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        node = 0
+        for c in text:
+            while node and c not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(c, 0)
+            if out[node]:
+                found.update(out[node])
+        return found
+
+
+def parse_process_pattern(pattern):
+    # Splits a process pattern into its kind and value.  Patterns are
+    # substrings of the command line unless prefixed with re: (regular
+    # expression searched in the command line, use ^ to anchor), glob:
+    # (shell wildcard matched against the whole command line) or exe:
+    # (exact basename of the executable, the first word of the command line)
+    pattern = str(pattern)
+    for kind in PROCESS_PATTERN_KINDS:
+        if pattern.startswith(kind + ':'):
+            return kind, pattern[len(kind) + 1:]
+    return 'substring', pattern
+
+
+def compile_process_pattern(pattern):
+    # Returns the function a re: or glob: pattern is tested with (search
+    # for re:, a match of the whole command line for glob:), compiled once
+    # per pattern for the life of the process
+    test = _process_regexes.get(pattern)
+    if test is not None:
+        return test
+    kind, value = parse_process_pattern(pattern)
+    if kind == 're':
+        try:
+            test = re.compile(value, re.S).search
+        except re.error as e:
+            raise ValueError("invalid process regular expression '%s': %s" % (value, e))
+    elif kind == 'glob':
+        test = re.compile(fnmatch.translate(value)).match
+    else:
+        return None
+    _process_regexes[pattern] = test
+    return test
+
+
+def regex_literals(parsed, literals):
+    # Adds the runs of literal characters every match of the parsed regular
+    # expression contains to literals.  Zero width assertions (^, \b...) do
+    # not break a run, case insensitive groups and optional items are
+    # skipped.
+    run = list()
+    for op, av in parsed:
+        if op == sre_parse.LITERAL:
+            try:
+                run.append(chr(av))
+                continue
+            except ValueError:
+                # not a byte on Python 2, ends the run
+                pass
+        if op == sre_parse.AT:
+            continue
+        if run:
+            literals.append(''.join(run))
+            run = list()
+        if op in REGEX_GROUPS:
+            # (group, add_flags, del_flags, pattern) or (group, pattern)
+            if op == sre_parse.SUBPATTERN and len(av) == 4 and av[1] & sre_parse.SRE_FLAG_IGNORECASE:
+                continue
+            regex_literals(av[-1] if op == sre_parse.SUBPATTERN else av, literals)
+        elif op in REGEX_REPEATS and av[0] > 0:
+            regex_literals(av[2], literals)
+    if run:
+        literals.append(''.join(run))
+
+
+def required_literal(pattern):
+    # The longest substring every command line matching a re: or glob:
+    # pattern contains, None when there is none
+    kind, value = parse_process_pattern(pattern)
+    if kind == 'glob':
+        value = fnmatch.translate(value)
+    elif kind != 're':
+        return None
+    try:
+        parsed = sre_parse.parse(value, re.S)
+    except (re.error, OverflowError, RuntimeError):
+        return None
+    flags = parsed.state.flags if hasattr(parsed, 'state') else parsed.pattern.flags
+    if flags & sre_parse.SRE_FLAG_IGNORECASE:
+        return None
+    literals = list()
+    regex_literals(parsed, literals)
+    return max(literals, key=len) if literals else None
+
+
+class ProcessMatcher(object):
+    # Combined matcher for every process pattern of the signatures being
+    # scored.  Each command line is scanned once by an Aho-Corasick
+    # automaton holding the substrings, and the literals the re: and glob:
+    # patterns require, plus one dictionary lookup for the executable names.
+    # The re: and glob: patterns are compiled separately and only tested
+    # against the command lines holding their literal.
+    def __init__(self, patterns):
+        self.patterns = list()
+        self.ids = dict()
+        literals = list()
+        self.literal_ids = list()
+        self.exe = dict()
+        # patterns without a literal, tested against every command line
+        self.regexes = list()
+
+        seen = set()
+        for p in patterns:
+            p = str(p)
+            if p in seen:
+                continue
+            seen.add(p)
+            self.patterns.append(p)
+            pid = len(self.patterns) - 1
+            self.ids[p] = pid
+            kind, value = parse_process_pattern(p)
+            if kind == 'substring':
+                literals.append(value)
+                self.literal_ids.append((pid, None))
+            elif kind == 'exe':
+                self.exe.setdefault(value, list()).append(pid)
+            else:
+                test = compile_process_pattern(p)
+                literal = required_literal(p)
+                if literal is None:
+                    self.regexes.append((pid, test))
+                else:
+                    literals.append(literal)
+                    self.literal_ids.append((pid, test))
+        self.automaton = AhoCorasick(literals)
+
+    def search(self, command, only=None):
+        # ids of the patterns found in command, among the ids in only when
+        # it is given
+        found = set()
+        for i in self.automaton.search(command):
+            pid, test = self.literal_ids[i]
+            if only is not None and pid not in only:
+                continue
+            if test is None or test(command) is not None:
+                found.add(pid)
+        if self.exe:
+            words = command.split(None, 1)
+            if words:
+                found.update(pid for pid in self.exe.get(os.path.basename(words[0]), ())
+                             if only is None or pid in only)
+        for pid, test in self.regexes:
+            if (only is None or pid in only) and test(command) is not None:
+                found.add(pid)
+        return found
+
+    def scan(self, commands, weights=None, patterns=None):
+        # number of commands each pattern (or each of patterns when given)
+        # was found in, a command counting as its weight (the number of
+        # collapsed workers) when weights are given
+        only = None
+        if patterns is None:
+            hits = dict((p, 0) for p in self.patterns)
+        else:
+            only = set(self.ids[str(p)] for p in patterns)
+            hits = dict((self.patterns[i], 0) for i in only)
+        for j, command in enumerate(commands):
+            found = self.search(command, only)
+            if found:
+                weight = 1 if weights is None else weights[j]
+                for i in found:
+                    hits[self.patterns[i]] += weight
+        return hits
+
+
+def get_process_matcher(patterns):
+    # compiled matchers are cached for the life of the process, keyed by
+    # the distinct patterns
+    key = tuple(sorted(set(str(p) for p in patterns)))
+    matcher = _process_matchers.get(key)
+    if matcher is None:
+        matcher = ProcessMatcher(key)
+        _process_matchers[key] = matcher
+    return matcher
+
+
+class PathProbe(object):
+    # Checks for the existence of every distinct path once.  With scandir,
+    # paths sharing a parent directory are resolved from a single listing
+    # of that directory.  With a timeout, probes run in worker threads and
+    # a probe that does not finish in time (i.e. a hung NFS mount) is
+    # abandoned and reported as missing.
+    workers = 8
+
+    def __init__(self, paths, timeout=None, scandir=False):
+        self.paths = list()
+        seen = set()
+        for p in paths:
+            if p not in seen:
+                seen.add(p)
+                self.paths.append(p)
+        self.timeout = timeout
+        self.scandir = scandir
+        self.results = dict()
+        self.timed_out = list()
+
+    def groups(self):
+        # units of work, a parent directory and the paths below it
+        if not self.scandir:
+            return [(None, [p]) for p in self.paths]
+        groups = dict()
+        order = list()
+        for p in self.paths:
+            parent = os.path.dirname(p)
+            if parent not in groups:
+                groups[parent] = list()
+                order.append(parent)
+            groups[parent].append(p)
+        return [(parent, groups[parent]) for parent in order]
+
+    def probe(self, parent, paths):
+        found = dict()
+        if parent is None or len(paths) < 2 or not hasattr(os, 'scandir'):
+            for p in paths:
+                found[p] = exists(p)
+            return found
+        try:
+            entries = dict((e.name, e) for e in os.scandir(parent))
+        except (IOError, OSError):
+            entries = None
+        for p in paths:
+            name = os.path.basename(p)
+            if entries is None or not name:
+                found[p] = exists(p)
+            elif name not in entries:
+                found[p] = False
+            elif entries[name].is_symlink():
+                # exists() follows symlinks
+                found[p] = exists(p)
+            else:
+                found[p] = True
+        return found
+
+    def run(self):
+        groups = self.groups()
+        if not self.timeout:
+            for parent, paths in groups:
+                self.results.update(self.probe(parent, paths))
+            return self.results
+
+        pending = deque(groups)
+        done = dict()
+        started = dict()
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    work = pending.popleft()
+                    started[id(work)] = (time.time(), work)
+                found = self.probe(*work)
+                with lock:
+                    if id(work) in started:
+                        del started[id(work)]
+                        done.update(found)
+
+        def spawn():
+            t = threading.Thread(target=worker)
+            t.daemon = True
+            t.start()
+
+        for i in range(min(self.workers, len(groups))):
+            spawn()
+        while True:
+            with lock:
+                now = time.time()
+                for key, (begin, work) in list(started.items()):
+                    if now - begin > self.timeout:
+                        # abandon the hung worker and replace it
+                        del started[key]
+                        for p in work[1]:
+                            done[p] = False
+                            self.timed_out.append(p)
+                        if pending:
+                            spawn()
+                finished = not pending and not started
+            if finished:
+                break
+            time.sleep(0.01)
+        self.results.update(done)
+        return self.results
+
+
+def count_processes(patterns, proc_hits, process_hits):
+    count = 0
+    for p in patterns:
+        hits = proc_hits.get(str(p), 0)
+        if process_hits == 'pattern':
+            count += 1 if hits > 0 else 0
+        else:
+            count += hits
+    return count
+
+
+def count_members(items, index_set):
+    count = 0
+    for i in items:
+        if i in index_set:
+            count += 1
+    return count
+
+
+def match_processes(signatures, index, matcher=None):
+    # matcher holds the patterns of the whole catalog, so one is built per
+    # run rather than per set of signatures left by the short-circuit
+    patterns = list()
+    for sig in signatures:
+        patterns.extend(sig['processes'])
+    if len(patterns) < 1:
+        return dict()
+    if matcher is None:
+        matcher = get_process_matcher(patterns)
+    return matcher.scan(index.commands, index.command_weights, patterns)
+
+
+def probe_paths(signatures, timeout=None, scandir=False):
+    paths = list()
+    for sig in signatures:
+        paths.extend(sig['paths'])
+    probe = PathProbe(paths, timeout, scandir)
+    probe.run()
+    return probe
+
+
+class SignatureScorer(object):
+    # Scores signatures against a host's fact index, one category at a time
+    # from the cheapest to the most expensive.  With short_circuit, a
+    # signature stops being evaluated as soon as one of its thresholds can
+    # not be met, and the shared process scan only covers the signatures
+    # still in the running.  The path probe covers every path of the
+    # catalog, so the returned path results can re-score any signature.
+    # Paths are probed on the running host with path_prober, unless
+    # path_results (a dict of path to existence) was already collected.  With explain, the time spent
+    # per category, the matched items and the failed threshold of every
+    # signature are recorded in self.explain.
+    def __init__(self, index, process_hits='process', path_timeout=None, path_scandir=False, short_circuit=True,
+                 path_results=None, explain=False, path_prober=probe_paths):
+        self.index = index
+        self.process_hits = process_hits
+        self.path_timeout = path_timeout
+        self.path_scandir = path_scandir
+        self.short_circuit = short_circuit
+        self.path_results = path_results
+        self.path_prober = path_prober
+        self.proc_hits = dict()
+        self.matcher = None
+        self.catalog = list()
+        self.path_probe = PathProbe([])
+        self.explain = dict(stages=dict(), signatures=list()) if explain else None
+
+    def prepare(self, category, signatures):
+        # shared, per host work for the signatures about to be evaluated
+        start = time.time()
+        if category == 'processes':
+            self.proc_hits = match_processes(signatures, self.index, self.matcher)
+        elif category == 'paths' and self.path_results is None:
+            self.path_probe = self.path_prober(self.catalog, self.path_timeout, self.path_scandir)
+        else:
+            return
+        if self.explain is not None:
+            self.explain['stages'][category] = round(time.time() - start, 6)
+
+    def unreachable(self, category, sig):
+        # True when the threshold can not be met even if every item hits
+        if category == 'processes' and self.process_hits == 'process':
+            return False
+        return len(sig[category]) < sig['scores'][category]
+
+    def count(self, category, sig):
+        index = self.index
+        if category == 'services':
+            return count_members(sig['services'], index.services)
+        if category == 'packages':
+            return len([p for p in sig['packages'] if index.has_package(p)])
+        if category == 'users':
+            return count_members(sig['users'], index.users)
+        if category == 'groups':
+            return count_members(sig['groups'], index.groups)
+        if category == 'ports':
+            return len([p for p in sig['ports'] if index.match_port(p)])
+        if category == 'processes':
+            return count_processes(sig['processes'], self.proc_hits, self.process_hits)
+        if category == 'paths':
+            path_results = self.path_probe.results if self.path_results is None else self.path_results
+            return len([p for p in sig['paths'] if path_results.get(p)])
+        return 0
+
+    def matched(self, category, sig):
+        # the items of a category that hit, for explain
+        index = self.index
+        if category in ['services', 'users', 'groups']:
+            return [i for i in sig[category] if i in getattr(index, category)]
+        if category == 'packages':
+            return [p if not isinstance(p, dict) else p['spec'] for p in sig['packages'] if index.has_package(p)]
+        if category == 'ports':
+            return [p for p in sig['ports'] if index.match_port(p)]
+        if category == 'processes':
+            return [p for p in sig['processes'] if self.proc_hits.get(str(p))]
+        if category == 'paths':
+            path_results = self.path_probe.results if self.path_results is None else self.path_results
+            return [p for p in sig['paths'] if path_results.get(p)]
+        return list()
+
+    def score(self, signatures, catalog=None):
+        # catalog, the signatures of the whole run when only part of them
+        # is scored, keys the cached process matcher and sets the paths
+        # probed
+        started = time.time()
+        self.catalog = catalog if catalog is not None else signatures
+        patterns = list()
+        for sig in self.catalog:
+            patterns.extend(sig['processes'])
+        self.matcher = get_process_matcher(patterns) if patterns else None
+        states = list()
+        for sig in signatures:
+            states.append(dict(
+                sig=sig,
+                counters=dict((COUNTERS[c], 0) for c in SCORE_CATEGORIES),
+                failed=None,
+                skipped=list(),
+                timings=dict(),
+                matched=dict()
+            ))
+
+        for category in COST_ORDER:
+            live = [st for st in states if st['failed'] is None or not self.short_circuit]
+            self.prepare(category, [st['sig'] for st in live])
+            for st in states:
+                sig = st['sig']
+                if st['failed'] is not None and self.short_circuit:
+                    st['skipped'].append(category)
+                    continue
+                if self.short_circuit and self.unreachable(category, sig):
+                    st['failed'] = category
+                    continue
+                if self.explain is None:
+                    count = self.count(category, sig)
+                else:
+                    start = time.time()
+                    count = self.count(category, sig)
+                    st['matched'][category] = self.matched(category, sig)
+                    st['timings'][category] = round(time.time() - start, 6)
+                st['counters'][COUNTERS[category]] = count
+                if count < sig['scores'][category] and st['failed'] is None:
+                    st['failed'] = category
+
+        if self.explain is not None:
+            self.explain['stages']['total'] = round(time.time() - started, 6)
+            for st in states:
+                failed = None
+                if st['failed'] is not None:
+                    failed = dict(category=st['failed'], required=st['sig']['scores'][st['failed']],
+                                  count=st['counters'][COUNTERS[st['failed']]],
+                                  evaluated=st['failed'] in st['timings'])
+                self.explain['signatures'].append(dict(
+                    name=st['sig']['application'].get('name'),
+                    time=round(sum(st['timings'].values()), 6),
+                    timings=st['timings'],
+                    matched=st['matched'],
+                    failed=failed
+                ))
+
+        results = list()
+        for st in states:
+            app_id = st['sig']['application']
+            results.append(dict(
+                name=app_id.get('name'),
+                tag_name=app_id.get('tag_name'),
+                identified=st['failed'] is None,
+                counters=st['counters'],
+                skipped_categories=st['skipped']
+            ))
+        return results
+
+
+def score_signatures(signatures, scorer, apps):
+    discovered_apps = list(apps)
+    results = scorer.score(signatures)
+    for sig, r in zip(signatures, results):
+        if r['identified'] and sig['application'] not in discovered_apps:
+            discovered_apps.append(sig['application'])
+    return discovered_apps, results
+
+
+MODULE_ARGS = dict(
+    services=dict(
+        type='list',
+        default=list(),
+        required=False
+    ),
+    users=dict(
+        type='list',
+        default=list(),
+        required=False
+    ),
+    groups=dict(
+        type='list',
+        default=list(),
+        required=False
+    ),
+    paths=dict(
+        type='list',
+        default=list(),
+        required=False
+    ),
+    packages=dict(
+        type='list',
+        default=list(),
+        required=False
+    ),
+    processes=dict(
+        type='list',
+        default=list(),
+        required=False
+    ),
+    ports=dict(
+        type='list',
+        default=list(),
+        required=False
+    ),
+    application=dict(
+        type='dict',
+        default=dict(
+            name="",
+            desc=""
         ),
-        facts=dict(
-            type='dict',
-            required=True
+        required=False
+    ),
+    scores=dict(
+        type='dict',
+        default=dict(
+            users=0,
+            groups=0,
+            services=0,
+            paths=0,
+            packages=0,
+            processes=0,
+            ports=0
         ),
-        discovered_apps=dict(
-            type='list',
-            default=list(),
-            required=False
-        )
+        required=False
+    ),
+    facts=dict(
+        type='dict',
+        required=False
+    ),
+    discovered_apps=dict(
+        type='list',
+        default=list(),
+        required=False
+    ),
+    signatures=dict(
+        type='list',
+        required=False
+    ),
+    process_hits=dict(
+        type='str',
+        default='process',
+        choices=['process', 'pattern'],
+        required=False
+    ),
+    path_timeout=dict(
+        type='float',
+        default=5.0,
+        required=False
+    ),
+    path_scandir=dict(
+        type='bool',
+        default=False,
+        required=False
+    ),
+    short_circuit=dict(
+        type='bool',
+        default=True,
+        required=False
+    ),
+    explain=dict(
+        type='bool',
+        default=False,
+        required=False
+    ),
+    scoring=dict(
+        type='str',
+        default='controller',
+        choices=['controller', 'remote'],
+        required=False
+    ),
+    probe_paths=dict(
+        type='list',
+        required=False
+    ),
+    memo_dir=dict(
+        type='path',
+        required=False
+    ),
+    memo_size=dict(
+        type='int',
+        default=4096,
+        required=False
+    ),
+    state_dir=dict(
+        type='path',
+        required=False
     )
+)
+
+REQUIRED_ONE_OF = [['facts', 'probe_paths']]
 
+
+def identify(params, scorer):
+    # Scores the signature(s) given in the module parameters and returns
+    # the module result, raises ValueError for an invalid signature
     result = dict(
         changed=False,
         original_message='',
         message=''
     )
-
-    module = AnsibleModule(
-        argument_spec=module_args,
-        supports_check_mode=True
-    )
-
-    params = module.params
-
-    # if params['output_ps_stdout_lines']:
-    #     processes['ps_stdout_lines'] = raw_procs['stdout']
-    # if params['output_parsed_processes']:
-    #     processes['total_running_processes'] = raw_procs['total_running_processes']
-    #     processes['processes'] = proc_data
-    # result = {'ansible_facts': {'running_processes': processes}}
-    #
-    # module.exit_json(**result)
-
-    # init counters
-    svc_count = 0
-    user_count = 0
-    group_count = 0
-    path_count = 0
-    pkg_count = 0
-    proc_count = 0
-    port_count = 0
-
-    chk_services = params['services']
-    chk_users = params['users']
-    chk_groups = params['groups']
-    chk_paths = params['paths']
-    chk_packages = params['packages']
-    chk_processes = params['processes']
-    chk_ports = params['ports']
-    app_id = params['application']
-    scores = params['scores']
-    facts = params['facts']
     apps = params['discovered_apps']
 
-    # check services
-    if len(chk_services) > 0 and facts.get('services'):
-        for s in chk_services:
-            if facts['services'].get(s) is not None:
-                svc_count += 1
-
-    # check users
-    if len(chk_users) > 0 and facts.get('local_users'):
-        # build user list
-        user_list = list()
-        for u in facts['local_users']:
-            if u.get('user') is not None:
-                user_list.append(u['user'])
-        for u in chk_users:
-            if u in user_list:
-                user_count += 1
-
-    # check groups
-    if len(chk_groups) > 0 and facts.get('local_groups'):
-        # build group list
-        group_list = list()
-        for g in facts['local_groups']:
-            if g.get('group') is not None:
-                group_list.append(g['group'])
-        for g in chk_groups:
-            if g in group_list:
-                group_count += 1
-
-    # check packages
-    if len(chk_packages) > 0 and facts.get('packages'):
-        for p in chk_packages:
-            if facts['packages'].get(p) is not None:
-                pkg_count += 1
-
-    # check processes
-    if len(chk_processes) > 0 and len(facts['running_processes']['processes']) > 0:
-        # build process list
-        proc_list = list()
-        for p in facts['running_processes']['processes']:
-            if p.get('command') is not None:
-                proc_list.append(p['command'])
-        for p in chk_processes:
-            for proc in proc_list:
-                if str(p) in str(proc):
-                    proc_count += 1
-
-    # check ports
-    # if len(chk_ports) > 0:
-    #     for p in chk_ports:
-
-    # check paths
-    if len(chk_paths) > 0:
-        for p in chk_paths:
-            if exists(p):
-                path_count += 1
-
-    # Scoring
-    if svc_count >= int(scores['services']) and user_count >= int(scores['users']) and \
-        group_count >= int(scores['groups']) and path_count >= int(scores['paths']) and \
-        pkg_count >= int(scores['packages']) and proc_count >= int(scores['processes']) and \
-        port_count >= int(scores['ports']):
+    if params['signatures'] is not None:
+        # Batch mode, score every signature in this single execution.  An
+        # empty catalog identifies nothing, it must not fall back to the
+        # per-signature options and their always matching defaults
+        try:
+            signatures = [normalize_signature(s) for s in params['signatures']]
+        except (AttributeError, TypeError, ValueError) as e:
+            raise ValueError("Invalid application signature: %s" % e)
+        discovered_apps, results = score_signatures(signatures, scorer, apps)
+        path_probe = scorer.path_probe
+        identified = [r['name'] for r in results if r['identified']]
+        result = {'ansible_facts': {'discovered_apps': discovered_apps,
+                                    'application_signature_paths': path_probe.results},
+                  'changed': len(identified) > 0,
+                  'signature_results': results,
+                  'path_probe': {'probed': len(path_probe.paths), 'timed_out': path_probe.timed_out},
+                  'msg': "%d of %d application signatures identified" % (len(identified), len(results))}
+        if scorer.explain is not None:
+            result['signature_explain'] = scorer.explain
+        return result
+
+    try:
+        sig = normalize_signature(params)
+    except (AttributeError, TypeError, ValueError) as e:
+        raise ValueError("Invalid application signature: %s" % e)
+    score = scorer.score([sig])[0]
+    if score['identified']:
         # App is identified
         if len(apps) < 1:
-            discovered_apps = [app_id]
+            discovered_apps = [sig['application']]
         else:
             discovered_apps = apps
-            discovered_apps.append(app_id)
-        result = {'ansible_facts': {'discovered_apps': discovered_apps}, 'changed': True, 'msg': {'user_count': user_count, 'group_count': group_count,'svc_count': svc_count, 'port_count': port_count, 'proc_count': proc_count, 'pkg_count': pkg_count, 'path_count': path_count}}
-        module.exit_json(**result)
+            discovered_apps.append(sig['application'])
+        result = {'ansible_facts': {'discovered_apps': discovered_apps}, 'changed': True, 'msg': score['counters']}
     else:
         # not identified
-        result['msg'] = {'user_count': user_count, 'group_count': group_count,'svc_count': svc_count, 'port_count': port_count, 'proc_count': proc_count, 'pkg_count': pkg_count, 'path_count': path_count}
+        result['msg'] = score['counters']
+        result['skipped_categories'] = score['skipped_categories']
         result['skipped'] = True
-        module.exit_json(**result)
+    if scorer.explain is not None:
+        result['signature_explain'] = scorer.explain
+    return result
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=MODULE_ARGS,
+        required_one_of=REQUIRED_ONE_OF,
+        supports_check_mode=True
+    )
+
+    params = module.params
+
+    if params['probe_paths'] is not None:
+        # Only check paths, for the controller side scoring of the
+        # application_id action plugin
+        probe = PathProbe(params['probe_paths'], params['path_timeout'], params['path_scandir'])
+        probe.run()
+        module.exit_json(changed=False, path_results=probe.results,
+                         path_probe={'probed': len(probe.paths), 'timed_out': probe.timed_out})
+
+    scorer = SignatureScorer(FactIndex(params['facts']), params['process_hits'], params['path_timeout'],
+                             params['path_scandir'], params['short_circuit'], explain=params['explain'])
+    try:
+        result = identify(params, scorer)
+    except ValueError as e:
+        module.fail_json(msg=str(e))
+    module.exit_json(**result)
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,343 @@
+#!/usr/bin/python
+
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+ANSIBLE_METADATA = {'metadata_version': '1.1',
+                    'status': ['preview'],
+                    'supported_by': 'community'}
+
+DOCUMENTATION = '''
+---
+module: signature_catalog
+short_description: Compiles application signature roles into a single catalog file
+version_added: "2.8"
+description:
+    - "Reads the defaults/main.yml of every application signature role and writes one validated JSON catalog that the application_id module can score directly.  Signatures are validated with the normalize_signature function of the application_id module."
+    - "Only roles whose tasks/main.yml is the stock application_id call (plus debug tasks) are compiled, scoring their defaults is then the same as running them.  Other roles, and roles without amf_as_discovered_app, are returned in include_roles to be run with include_role.  Roles with an invalid signature are left out with a warning."
+    - "Roles whose defaults/main.yml and tasks/main.yml have an unchanged modification time, or an unchanged content hash, are reused from the existing catalog instead of being parsed again.  The catalog is only rewritten when a role was added, removed or changed."
+    - "This module is meant to run on the Ansible controller."
+options:
+    roles_path:
+        description:
+            - Directory containing the application signature roles.
+        required: True
+    dest:
+        description:
+            - Path of the JSON catalog file to create or update.
+        required: True
+    prefix:
+        description:
+            - Directory name prefix identifying application signature roles.
+        default: amf-application-signature-
+        required: False
+    application_id:
+        description:
+            - Path of the application_id module the signatures are validated with.
+            - Defaults to library/application_id.py next to roles_path.
+        required: False
+requirements:
+    - PyYAML
+author:
+    - Ansible Migration Factory
+'''
+
+EXAMPLES = '''
+- name: "Compile application signature catalog"
+  signature_catalog:
+    roles_path: "{{ playbook_dir }}/roles"
+    dest: "{{ playbook_dir }}/signature_catalog.json"
+  delegate_to: "localhost"
+  run_once: True
+'''
+
+RETURN = '''
+catalog:
+    description: Path of the catalog file
+    returned: always
+    type: str
+    sample: /var/lib/awx/projects/discovery/signature_catalog.json
+version:
+    description: Hash identifying the catalog contents, changes whenever any signature changes
+    returned: always
+    type: str
+    sample: 3a1f0c3e0b6f3a5f4e1f6d1c4b1a7a2f9c0d8e7b
+signatures:
+    description: Number of signatures in the catalog
+    returned: always
+    type: int
+    sample: 300
+rebuilt:
+    description: Roles that were parsed during this run
+    returned: always
+    type: list
+    sample: ["amf-application-signature-samba"]
+include_roles:
+    description: Roles that are not in the catalog and must be run with include_role
+    returned: always
+    type: list
+    sample: ["amf-application-signature-custom"]
+invalid:
+    description: Roles left out because their signature is invalid, with the reason
+    returned: always
+    type: dict
+    sample: {"amf-application-signature-broken": "invalid port 'http'"}
+'''
+
+from ansible.module_utils.basic import AnsibleModule
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+try:
+    import yaml
+    HAS_YAML = True
+except ImportError:
+    HAS_YAML = False
+
+CATALOG_FORMAT = 2
+SCORE_CATEGORIES = ['users', 'groups', 'services', 'paths', 'packages', 'processes', 'ports']
+ROLE_FILES = [os.path.join('defaults', 'main.yml'), os.path.join('tasks', 'main.yml')]
+
+# arguments of the application_id call in the tasks of a stock application
+# signature role, without whitespace
+STOCK_ARGS = dict(
+    application='{{amf_as_discovered_app}}',
+    facts='{{fact_subset}}',
+    users='{{amf_as_user_group.users}}',
+    groups='{{amf_as_user_group.groups}}',
+    paths='{{amf_as_paths}}',
+    packages='{{amf_as_packages}}',
+    ports='{{amf_as_ports}}',
+    processes='{{amf_as_processes}}',
+    services='{{amf_as_services}}',
+    scores='{{amf_as_scores}}',
+    discovered_apps='{{ansible_facts.discovered_apps|default([])}}'
+)
+TASK_KEYWORDS = ['name', 'register']
+
+
+def load_application_id(path):
+    # signatures are validated by the module that scores them
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location('application_id', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    except ImportError:
+        import imp
+        return imp.load_source('application_id', path)
+
+
+def role_sha1(paths):
+    sha1 = hashlib.sha1()
+    for path in paths:
+        sha1.update(path.encode('utf-8'))
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def role_stats(paths):
+    # [mtime, size] of every role file, None for a missing one
+    stats = list()
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stats.append([st.st_mtime, st.st_size])
+        except (IOError, OSError):
+            stats.append(None)
+    return stats
+
+
+def is_stock_tasks(tasks):
+    # True when the tasks are a single application_id call with the stock
+    # arguments and debug tasks, which scoring the role's defaults in the
+    # catalog is equivalent to
+    if not isinstance(tasks, list):
+        return False
+    calls = 0
+    for task in tasks:
+        if not isinstance(task, dict):
+            return False
+        modules = [k for k in task if k not in TASK_KEYWORDS]
+        if modules == ['debug']:
+            continue
+        if modules != ['application_id'] or not isinstance(task['application_id'], dict):
+            return False
+        args = dict((k, re.sub(r'\s', '', str(v))) for k, v in task['application_id'].items())
+        if args != STOCK_ARGS:
+            return False
+        calls += 1
+    return calls == 1
+
+
+def check_list(key, value):
+    if value is None:
+        return list()
+    if not isinstance(value, list):
+        raise ValueError("%s must be a list" % key)
+    return value
+
+
+def compile_signature(aid, role, defaults):
+    # Validates a role's amf_as_* defaults and returns the signature in the
+    # application_id option format, None when the role has no
+    # amf_as_discovered_app
+    if not isinstance(defaults, dict) or defaults.get('amf_as_discovered_app') is None:
+        return None
+    app = defaults.get('amf_as_discovered_app')
+    if not isinstance(app, dict) or not app.get('name'):
+        raise ValueError("amf_as_discovered_app must be a dictionary with a name")
+    user_group = defaults.get('amf_as_user_group') or dict()
+    if not isinstance(user_group, dict):
+        raise ValueError("amf_as_user_group must be a dictionary")
+    scores = defaults.get('amf_as_scores') or dict()
+    if not isinstance(scores, dict):
+        raise ValueError("amf_as_scores must be a dictionary")
+
+    sig = dict(
+        role=role,
+        application=app,
+        users=check_list('amf_as_user_group.users', user_group.get('users')),
+        groups=check_list('amf_as_user_group.groups', user_group.get('groups')),
+        services=check_list('amf_as_services', defaults.get('amf_as_services')),
+        paths=check_list('amf_as_paths', defaults.get('amf_as_paths')),
+        packages=check_list('amf_as_packages', defaults.get('amf_as_packages')),
+        processes=check_list('amf_as_processes', defaults.get('amf_as_processes')),
+        ports=check_list('amf_as_ports', defaults.get('amf_as_ports')),
+        scores=dict()
+    )
+    for category in SCORE_CATEGORIES:
+        try:
+            sig['scores'][category] = int(scores.get(category) or 0)
+        except (TypeError, ValueError):
+            raise ValueError("amf_as_scores.%s must be an integer" % category)
+    # the checks application_id applies when scoring the catalog
+    try:
+        aid.normalize_signature(sig)
+    except (TypeError, AttributeError) as e:
+        raise ValueError(str(e))
+    return sig
+
+
+def load_catalog(path):
+    try:
+        with open(path) as f:
+            catalog = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(catalog, dict) or catalog.get('format') != CATALOG_FORMAT:
+        return None
+    return catalog
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            roles_path=dict(type='path', required=True),
+            dest=dict(type='path', required=True),
+            prefix=dict(type='str', default='amf-application-signature-', required=False),
+            application_id=dict(type='path', required=False)
+        ),
+        supports_check_mode=True
+    )
+
+    if not HAS_YAML:
+        module.fail_json(msg="The signature_catalog module requires the PyYAML python library")
+
+    params = module.params
+    roles_path = params['roles_path']
+    dest = params['dest']
+    aid_path = params['application_id'] or os.path.join(os.path.dirname(os.path.abspath(roles_path)), 'library',
+                                                        'application_id.py')
+    try:
+        aid = load_application_id(aid_path)
+    except Exception as e:
+        module.fail_json(msg="Unable to load the application_id module from %s: %s" % (aid_path, e))
+
+    # roles are validated again when application_id changed
+    validator = role_sha1([aid_path])
+    old = load_catalog(dest)
+    if old is None or old.get('validator') != validator:
+        old = dict(sources=dict(), signatures=list(), include_roles=list(), invalid=dict())
+    old_signatures = dict((s['role'], s) for s in old['signatures'])
+    old_include = set(old['include_roles'])
+
+    try:
+        roles = sorted(r for r in os.listdir(roles_path) if r.startswith(params['prefix']) and
+                       os.path.isdir(os.path.join(roles_path, r)))
+    except (IOError, OSError) as e:
+        module.fail_json(msg="Unable to list roles in %s: %s" % (roles_path, e))
+
+    sources = dict()
+    signatures = list()
+    include_roles = list()
+    invalid = dict()
+    rebuilt = list()
+    for role in roles:
+        paths = [os.path.join(roles_path, role, f) for f in ROLE_FILES]
+        stats = role_stats(paths)
+
+        cached = old['sources'].get(role)
+        reusable = role in old_signatures or role in old_include or role in old['invalid']
+        if cached and reusable and cached['stats'] == stats:
+            sha1 = cached['sha1']
+        else:
+            sha1 = role_sha1(paths)
+            if not (cached and reusable and cached['sha1'] == sha1):
+                reusable = False
+        sources[role] = dict(stats=stats, sha1=sha1)
+        if reusable:
+            # unchanged, or touched but unchanged
+            if role in old_signatures:
+                signatures.append(old_signatures[role])
+            elif role in old_include:
+                include_roles.append(role)
+            else:
+                invalid[role] = old['invalid'][role]
+            continue
+
+        rebuilt.append(role)
+        try:
+            # a role without defaults or tasks is run with include_role
+            defaults = tasks = None
+            if os.path.isfile(paths[0]):
+                with open(paths[0]) as f:
+                    defaults = yaml.safe_load(f)
+            if os.path.isfile(paths[1]):
+                with open(paths[1]) as f:
+                    tasks = yaml.safe_load(f)
+            sig = compile_signature(aid, role, defaults)
+        except (IOError, OSError, ValueError, yaml.YAMLError) as e:
+            invalid[role] = str(e)
+            continue
+        if sig is None or not is_stock_tasks(tasks):
+            include_roles.append(role)
+        else:
+            signatures.append(sig)
+
+    for role in sorted(invalid):
+        module.warn("Application signature role %s is left out: %s" % (role, invalid[role]))
+
+    version = hashlib.sha1(''.join(role + sources[role]['sha1'] for role in roles).encode('utf-8')).hexdigest()
+    catalog = dict(format=CATALOG_FORMAT, version=version, validator=validator, sources=sources,
+                   signatures=signatures, include_roles=include_roles, invalid=invalid)
+
+    changed = catalog != old
+    if changed and not module.check_mode:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dest)), prefix='.signature_catalog')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(catalog, f, separators=(',', ':'), sort_keys=True)
+        module.atomic_move(tmp, dest)
+
+    module.exit_json(changed=changed, catalog=dest, version=version, signatures=len(signatures), rebuilt=rebuilt,
+                     include_roles=include_roles, invalid=invalid)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+# Linux /proc readers shared by the modules of the discovery roles: the
+# sockets listening for connections and the processes holding them
+
+import os
+import re
+import socket
+import struct
+from os.path import join
+
+# /proc/net files of the sockets that can listen for connections, and the
+# state of a listening socket (TCP_LISTEN, TCP_CLOSE for unconnected udp)
+NET_FILES = [('tcp', 'tcp', b'0A'), ('tcp6', 'tcp', b'0A'), ('udp', 'udp', b'07'), ('udp6', 'udp', b'07')]
+ZERO_ADDRESS = re.compile(br'^0+:0+$')
+
+
+def net_address(address):
+    # address and port of a /proc/net address, printed as hexadecimal words
+    # in host byte order
+    ip, port = address.split(':')
+    if len(ip) == 8:
+        ip = socket.inet_ntop(socket.AF_INET, struct.pack('=I', int(ip, 16)))
+    else:
+        ip = socket.inet_ntop(socket.AF_INET6, struct.pack('=4I', *[int(ip[i:i + 8], 16) for i in range(0, 32, 8)]))
+    return ip, int(port, 16)
+
+
+def read_file(path):
+    # raw read, /proc files are small and the io layers cost more than the
+    # read itself
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        chunks = list()
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        os.close(fd)
+    return b''.join(chunks)
+
+
+class SocketIndex(object):
+    # Joins the sockets listening for connections, from /proc/net/tcp, tcp6,
+    # udp and udp6, to the processes holding them, from the socket:[inode]
+    # links in /proc/<pid>/fd, in a single sweep without running any
+    # command.  Processes with more than max_fds open files are not swept,
+    # their number is kept in skipped.
+    def __init__(self, proc='/proc', max_fds=4096):
+        self.proc = proc
+        self.max_fds = max_fds
+        self.skipped = 0
+
+    def listeners(self):
+        # inode -> protocol, address and port of every listening socket
+        listeners = dict()
+        for name, protocol, state in NET_FILES:
+            try:
+                lines = read_file(join(self.proc, 'net', name)).splitlines()[1:]
+            except (IOError, OSError):
+                continue
+            for line in lines:
+                fields = line.split()
+                if len(fields) < 10 or fields[3] != state or (protocol == 'udp' and not ZERO_ADDRESS.match(fields[2])):
+                    continue
+                address, port = net_address(fields[1].decode('ascii'))
+                listeners[int(fields[9])] = dict(protocol=protocol, address=address, port=port)
+        return listeners
+
+    def owners(self, inodes):
+        # inode -> pids holding the socket, for the given inodes
+        owners = dict()
+        self.skipped = 0
+        for pid in sorted((p for p in os.listdir(self.proc) if p.isdigit()), key=int):
+            fd_dir = '%s/%s/fd' % (self.proc, pid)
+            try:
+                fds = os.listdir(fd_dir)
+                if len(fds) > self.max_fds:
+                    self.skipped += 1
+                    continue
+                for fd in fds:
+                    try:
+                        link = os.readlink('%s/%s' % (fd_dir, fd))
+                    except (IOError, OSError):
+                        continue
+                    if link.startswith('socket:['):
+                        inode = int(link[8:-1])
+                        if inode in inodes and pid not in owners.setdefault(inode, list()):
+                            owners[inode].append(pid)
+            except (IOError, OSError):
+                # exited, or not ours to read
+                continue
+        return owners
+
+    def join(self, processes):
+        # Sets listening, the sockets it listens on, on every process, and
+        # returns every listening socket with the pids holding it
+        listeners = self.listeners()
+        owners = self.owners(listeners)
+        by_pid = dict((p['pid'], p) for p in processes)
+        result = list()
+        for inode in sorted(listeners, key=lambda i: (listeners[i]['protocol'], listeners[i]['port'], i)):
+            listener = dict(listeners[inode], pids=owners.get(inode, list()))
+            for pid in listener['pids']:
+                if pid in by_pid:
+                    by_pid[pid].setdefault('listening', list()).append(listeners[inode])
+            result.append(listener)
+        return result
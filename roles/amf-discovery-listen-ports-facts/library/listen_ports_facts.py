@@ -20,11 +20,27 @@ version_added: "2.9"
 description:
     - Gather facts on processes listening on TCP and UDP ports.
 short_description: Gather facts on processes listening on TCP and UDP ports.
+options:
+    backend:
+        description:
+            - How listening sockets are collected.  C(proc) reads /proc/net/tcp, tcp6, udp and udp6, and finds the process holding every socket from the socket links in /proc/<pid>/fd, without running any command.  C(netstat) runs 'netstat -plunt', which requires net-tools.  C(auto) uses C(proc) when /proc/net/tcp exists, C(netstat) otherwise.
+            - With C(proc), name is the program name as a whole, netstat truncates it.
+        type: str
+        default: auto
+        choices: [auto, proc, netstat]
+    max_fds:
+        description:
+            - With the C(proc) backend, processes with more open files than this are not swept, and their sockets have no pid.
+        type: int
+        default: 4096
 '''
 
 EXAMPLES = r'''
 - name: Gather facts on listening ports
   listen_ports_facts:
+- name: Gather facts on listening ports without netstat
+  listen_ports_facts:
+    backend: proc
 - name: TCP whitelist violation
   debug:
     msg: TCP port {{ item.port }} by pid {{ item.pid }} violates the whitelist
@@ -133,10 +149,14 @@ ansible_facts:
           sample: "root"
 '''
 
-import re
+import os
 import platform
+import pwd
+import re
+import time
 from ansible.module_utils._text import to_native
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.procfs import SocketIndex
 
 
 def netStatParse(raw):
@@ -179,38 +199,107 @@ def netStatParse(raw):
     return results
 
 
+def procPidName(pid, proc='/proc'):
+    # program name of pid, like netstat reports it
+    try:
+        with open('%s/%d/cmdline' % (proc, pid), 'rb') as f:
+            name = os.path.basename(f.read().split(b'\0')[0])
+        if not name:
+            with open('%s/%d/comm' % (proc, pid), 'rb') as f:
+                name = f.read().strip()
+    except (IOError, OSError):
+        return ''
+    return name.decode('utf-8', 'replace')
+
+
+def procListenParse(sockets, proc='/proc'):
+    # listening sockets in the format of netStatParse, from /proc alone,
+    # with the lowest pid holding each socket
+    listeners = sockets.listeners()
+    owners = sockets.owners(listeners)
+    names = dict()
+    results = list()
+    for inode in sorted(listeners, key=lambda i: (listeners[i]['protocol'], listeners[i]['port'], i)):
+        pid = int(owners[inode][0]) if owners.get(inode) else 0
+        if pid and pid not in names:
+            names[pid] = procPidName(pid, proc)
+        result = {
+            'pid': pid,
+            'address': listeners[inode]['address'],
+            'port': listeners[inode]['port'],
+            'protocol': listeners[inode]['protocol'],
+            'name': names.get(pid, ''),
+        }
+        if result not in results:
+            results.append(result)
+    return results
+
+
+def procPidsInfo(pids, proc='/proc'):
+    # start time and user of every pid, in the formats of ps lstart and user
+    info = dict()
+    hz = os.sysconf('SC_CLK_TCK')
+    boot_time = None
+    with open(os.path.join(proc, 'stat')) as f:
+        for line in f:
+            if line.startswith('btime '):
+                boot_time = int(line.split()[1])
+                break
+    for pid in set(pid for pid in pids if pid):
+        try:
+            with open('%s/%d/stat' % (proc, pid)) as f:
+                stat = f.read()
+            starttime = int(stat[stat.rindex(')') + 2:].split()[19])
+            with open('%s/%d/status' % (proc, pid)) as f:
+                uid = int([line for line in f if line.startswith('Uid:')][0].split()[2])
+        except (IOError, OSError, ValueError, IndexError):
+            # exited meanwhile
+            continue
+        try:
+            user = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            user = str(uid)
+        stime = time.ctime(boot_time + starttime // hz) if boot_time is not None else ''
+        info[pid] = dict(stime=stime, user=user)
+    return info
+
+
 def main():
 
     module = AnsibleModule(
-        argument_spec={},
+        argument_spec=dict(
+            backend=dict(type='str', default='auto', choices=['auto', 'proc', 'netstat']),
+            max_fds=dict(type='int', default=4096),
+        ),
         supports_check_mode=True,
     )
 
     if platform.system() != 'Linux':
         module.fail_json(msg='This module requires Linux.')
 
-    def getPidSTime(pid):
+    def getPidsInfo(pids):
+        # start time and user of every pid, from a single ps call
+        info = dict()
+        pids = sorted(set(pid for pid in pids if pid))
+        if not pids:
+            return info
         ps_cmd = module.get_bin_path('ps', True)
-        rc, ps_output, stderr = module.run_command([ps_cmd, '-o', 'lstart', '-p', str(pid)])
-        stime = ''
-        if rc == 0:
-            for line in ps_output.splitlines():
-                if 'started' not in line:
-                    stime = line
-        return stime
-
-    def getPidUser(pid):
-        ps_cmd = module.get_bin_path('ps', True)
-        rc, ps_output, stderr = module.run_command([ps_cmd, '-o', 'user', '-p', str(pid)])
-        user = ''
-        if rc == 0:
-            for line in ps_output.splitlines():
-                if line != 'USER':
-                    user = line
-        return user
+        rc, ps_output, stderr = module.run_command([ps_cmd, '-o', 'pid=', '-o', 'user=', '-o', 'lstart=', '-p',
+                                                    ','.join(str(pid) for pid in pids)])
+        # ps returns 1 when one of the pids exited meanwhile
+        for line in ps_output.splitlines():
+            fields = line.split(None, 2)
+            if len(fields) == 3 and fields[0].isdigit():
+                info[int(fields[0])] = dict(stime=fields[2].rstrip(), user=fields[1])
+        return info
+
+    backend = module.params['backend']
+    if backend == 'auto':
+        backend = 'proc' if os.path.isfile('/proc/net/tcp') else 'netstat'
 
     result = {
         'changed': False,
+        'backend': backend,
         'ansible_facts': {
             'tcp_listen': [],
             'udp_listen': [],
@@ -218,19 +307,30 @@ def main():
     }
 
     try:
-        netstat_cmd = module.get_bin_path('netstat', True)
-
-        # which ports are listening for connections?
-        rc, stdout, stderr = module.run_command([netstat_cmd, '-plunt'])
-        if rc == 0:
-            netstatOut = netStatParse(stdout)
-            for p in netstatOut:
-                p['stime'] = getPidSTime(p['pid'])
-                p['user'] = getPidUser(p['pid'])
-                if p['protocol'] == 'tcp':
-                    result['ansible_facts']['tcp_listen'].append(p)
-                elif p['protocol'] == 'udp':
-                    result['ansible_facts']['udp_listen'].append(p)
+        netstatOut = list()
+        if backend == 'proc':
+            sockets = SocketIndex(max_fds=module.params['max_fds'])
+            netstatOut = procListenParse(sockets)
+            pids_info = procPidsInfo(p['pid'] for p in netstatOut)
+            if sockets.skipped:
+                module.warn("%d processes with more than %d open files were not searched for listening sockets" %
+                            (sockets.skipped, module.params['max_fds']))
+        else:
+            netstat_cmd = module.get_bin_path('netstat', True)
+
+            # which ports are listening for connections?
+            rc, stdout, stderr = module.run_command([netstat_cmd, '-plunt'])
+            if rc == 0:
+                netstatOut = netStatParse(stdout)
+                pids_info = getPidsInfo(p['pid'] for p in netstatOut)
+        for p in netstatOut:
+            info = pids_info.get(p['pid'], dict(stime='', user=''))
+            p['stime'] = info['stime']
+            p['user'] = info['user']
+            if p['protocol'] == 'tcp':
+                result['ansible_facts']['tcp_listen'].append(p)
+            elif p['protocol'] == 'udp':
+                result['ansible_facts']['udp_listen'].append(p)
     except (KeyError, EnvironmentError) as e:
         module.fail_json(msg=to_native(e))
 
@@ -15,6 +15,7 @@ version_added: "2.8"
 description:
     - "Collects the currently running processes on a system at the time the module is run."
     - "This module presents the currently running proceses as ansible_facts"
+    - "The filter options (include_commands, exclude_commands, users, min_rss, min_cpu and drop_kernel_threads) are applied on the host, before the output is built, to processes and ps_stdout_lines.  total_running_processes always counts every process."
 output_ps_stdout_lines:
     description:
         - Whether or not to output the collected standard out lines from the 'ps auxww' command
@@ -25,6 +26,108 @@ output_parsed_processes:
         - Whether or not to output parsed data from the 'ps auxww' command.
     default: True
     required: False
+backend:
+    description:
+        - How processes are collected.  C(proc) reads /proc/<pid>/stat, status and cmdline directly, without running any command, and reports the same fields as 'ps auxww'.  C(ps) runs and parses 'ps auxww'.  C(auto) uses C(proc) on Linux and C(ps) elsewhere.
+        - With C(proc), ps_stdout_lines are rendered from /proc in the 'ps auxww' layout.
+    default: auto
+    choices: [auto, proc, ps]
+    required: False
+output_format:
+    description:
+        - Layout of running_processes.  C(rows) returns processes as a list with one dictionary per process.
+        - C(columns) returns one list per field in running_processes.columns instead, so field names are not repeated for every process.  The repeated values of user, teletype, stat and start are interned, their column holds indexes into the list of distinct values in running_processes.values.  Use the expand_processes filter to turn it back into rows.
+    default: rows
+    choices: [rows, columns]
+    required: False
+include_commands:
+    description:
+        - Only return processes whose command matches (re.search) one of these regular expressions.
+    type: list
+    default: []
+    required: False
+exclude_commands:
+    description:
+        - Do not return processes whose command matches (re.search) one of these regular expressions.
+    type: list
+    default: []
+    required: False
+users:
+    description:
+        - Only return processes running as one of these users.
+    type: list
+    default: []
+    required: False
+min_rss:
+    description:
+        - Only return processes with a resident size of at least this many KiB.
+    type: int
+    default: 0
+    required: False
+min_cpu:
+    description:
+        - Only return processes with a cpu_percentage of at least this.
+    type: float
+    default: 0
+    required: False
+drop_kernel_threads:
+    description:
+        - Do not return kernel threads.  With the proc backend, kernel threads are skipped before their status and cmdline are read.
+    type: bool
+    default: False
+    required: False
+process_tree:
+    description:
+        - Also return running_processes.children, the pids of the children of every parent process, keyed by the parent pid.
+    type: bool
+    default: False
+    required: False
+collapse_workers:
+    description:
+        - Return the children of a parent running the same command as the same user (i.e. the workers of a prefork server) as a single entry, the first of them.  Its resident_size, cpu_percentage and memory_percentage are the totals of all of them, and workers is their number.  A process with no identical sibling is returned as is.
+        - ps_stdout_lines are not collapsed.
+    type: bool
+    default: False
+    required: False
+samples:
+    description:
+        - Number of /proc samples taken over sample_window seconds.  With more than one, every process gets a sampled_cpu_percentage, its cpu usage between the first and the last sample it was seen in (the cpu_percentage of ps is its lifetime average), and the processes that started and exited during the window are returned in running_processes.transient_processes.
+        - Samples only read /proc/<pid>/stat, every process is read in full once, by the first sample it is seen in, and reported with the ps fields of that read.  Requires the proc backend.
+    type: int
+    default: 1
+    required: False
+sample_window:
+    description:
+        - Seconds over which the samples are taken.
+    type: float
+    default: 10
+    required: False
+sample_cpu_budget:
+    description:
+        - Maximum cpu time the sampling may use, the full reads of the processes included, in percent of the time elapsed.  Samples are delayed to stay below it, and the ones that would then fall outside sample_window are not taken.
+    type: float
+    default: 5
+    required: False
+typed_fields:
+    description:
+        - Return pid, ppid, cpu_percentage, memory_percentage and sampled_cpu_percentage as numbers instead of strings, and virtual_memory_size and resident_size as a number of bytes instead of a string of KiB, so they can be compared and sorted without int or float filters.
+        - Filters (i.e. min_rss) are applied before the conversion, on the values of ps.
+    type: bool
+    default: False
+    required: False
+listening_ports:
+    description:
+        - Set listening, the sockets a process listens on (protocol, address and port), on every process, and return every listening socket with the pids holding it in running_processes.listeners.
+        - Listening sockets are read from /proc/net/tcp, tcp6, udp and udp6 and joined to processes from the socket links in /proc/<pid>/fd, in one sweep without running any command.  Linux only.  Sockets of processes the module can not read (i.e. when not run as root) have no pids.
+    type: bool
+    default: False
+    required: False
+max_fds:
+    description:
+        - With listening_ports, processes with more open files than this are not swept, and their sockets have no pids.
+    type: int
+    default: 4096
+    required: False
 author:
     - Andrew J. Huffman (@ahuffman)
 '''
@@ -40,6 +143,32 @@ EXAMPLES = '''
     output_ps_stdout_lines: True
     output_parsed_processes: False
 
+# Collect processes as one list per field
+- name: "Collect current running processes in columns"
+  scan_processes:
+    output_format: columns
+
+# Collect processes with the workers of prefork servers collapsed
+- name: "Collect current running processes, collapsing workers"
+  scan_processes:
+    collapse_workers: True
+
+# Sample processes 6 times over a minute, to catch short-lived processes
+- name: "Sample running processes"
+  scan_processes:
+    samples: 6
+    sample_window: 60
+
+# Collect processes with numeric fields as numbers, sizes in bytes
+- name: "Collect current running processes, typed"
+  scan_processes:
+    typed_fields: True
+
+# Collect processes with the ports they listen on
+- name: "Collect current running processes and their listening ports"
+  scan_processes:
+    listening_ports: True
+
 # Collect both parsed process data and 'ps auxww' command standard out
 - name: "Collect all process data"
   scan_processes:
@@ -53,6 +182,7 @@ running_processes:
         cpu_percentage: '0.0'
         memory_percentage: '0.0'
         pid: '1'
+        ppid: '0'
         resident_size: '5036'
         start: Jul08
         stat: Ss
@@ -60,16 +190,497 @@ running_processes:
         time: '3:32'
         user: root
       ...
+    # with typed_fields
+    processes:
+      - command: /usr/lib/systemd/systemd --switched-root --system --deserialize 33
+        cpu_percentage: 0.0
+        pid: 1
+        resident_size: 5156864
+        ...
+      ...
     ps_stdout_lines:
       - root         1  0.0  0.0 171628  5056 ?        Ss   Jul08   3:32 /usr/lib/systemd/systemd --switched-root --system --deserialize 33
       ...
     total_running_processes: 359
+    # with samples, processes that started and exited during the window
+    transient_processes:
+      - command: /bin/sh -c /usr/local/bin/backup.sh
+        pid: '40411'
+        sampled_cpu_percentage: '3.1'
+        ...
+      ...
+    # with listening_ports
+    listeners:
+      - address: 0.0.0.0
+        pids: ['1234', '1240']
+        port: 80
+        protocol: tcp
+      ...
+    # with process_tree
+    children:
+      '1': ['567', '612', ...]
+      ...
+    # with output_format columns, instead of processes
+    columns:
+      command: [/usr/lib/systemd/systemd --switched-root --system --deserialize 33, ...]
+      pid: ['1', ...]
+      user: [0, ...]
+      ...
+    values:
+      user: [root, ...]
+      ...
+# with samples, the samples taken, the seconds they took and the cpu seconds
+# they used
+sampling:
+    samples: 6
+    window: 60.004
+    cpu_seconds: 0.412
 '''
 
 from ansible.module_utils.basic import AnsibleModule
-import os, re, subprocess
+from ansible.module_utils.procfs import SocketIndex, read_file
+import os, pwd, re, subprocess, sys, time
 from os.path import isfile, isdir, join
 
+# one 'ps auxww' line, the groups are named after the process fields
+RE_PS = re.compile(r'^(?P<user>[\w\+\-\_\$\d]+)\s+(?P<pid>[0-9]+)\s+(?P<cpu_percentage>[0-9\.]+)\s+(?P<memory_percentage>[0-9\.]+)\s+(?P<virtual_memory_size>[0-9]+)\s+(?P<resident_size>[0-9]+)\s+(?P<teletype>[a-zA-Z0-9\?\/\-]+)\s+(?P<stat>[ADIRSTtWXZ\<NLsl\+]+)\s+(?P<start>[\w\:\d]+\s?[\d]{2})\s+(?P<time>[0-9\:]+)\s+(?P<command>.*)$')
+
+PS_LINE = '%-8s %5s %4s %4s %6s %5s %-8s %-4s %5s %6s %s'
+STATUS_SIZES = re.compile(br'^(VmLck|VmSize|VmRSS):\s+(\d+)', re.M)
+# flag of kernel threads in /proc/<pid>/stat
+PF_KTHREAD = 0x00200000
+
+
+def compile_commands(option, patterns):
+    # every regular expression is compiled on its own, so inline flags and
+    # backreferences keep their meaning
+    searches = list()
+    for pattern in patterns:
+        try:
+            searches.append(re.compile(pattern).search)
+        except re.error as e:
+            raise re.error("%s regular expression '%s': %s" % (option, pattern, e))
+    return searches
+
+
+def process_filter(params):
+    # Returns a function telling whether a parsed process passes the filter
+    # options, None when no filter is set.  Raises re.error for an invalid
+    # regular expression.
+    include = compile_commands('include_commands', params['include_commands'])
+    exclude = compile_commands('exclude_commands', params['exclude_commands'])
+    users = set(params['users'])
+    min_rss = params['min_rss']
+    min_cpu = params['min_cpu']
+    drop_kernel_threads = params['drop_kernel_threads']
+    if not (include or exclude or users or min_rss or min_cpu or drop_kernel_threads):
+        return None
+
+    def keep(p):
+        command = p['command']
+        if drop_kernel_threads and p['virtual_memory_size'] == '0' and command.startswith('[') and \
+                not command.endswith('<defunct>'):
+            return False
+        if users and p['user'] not in users:
+            return False
+        if min_rss and int(p['resident_size']) < min_rss:
+            return False
+        if min_cpu and float(p['cpu_percentage']) < min_cpu:
+            return False
+        if include and not any(search(command) is not None for search in include):
+            return False
+        if exclude and any(search(command) is not None for search in exclude):
+            return False
+        return True
+    return keep
+
+
+class ProcReader(object):
+    # Reads the running processes from /proc and reports them with the
+    # fields and formats of 'ps auxww', without running ps
+    def __init__(self, proc='/proc'):
+        self.proc = proc
+        self.hz = os.sysconf('SC_CLK_TCK')
+        self.page_kb = os.sysconf('SC_PAGE_SIZE') // 1024
+        self.now = time.time()
+        self.uptime = float(read_file(join(proc, 'uptime')).split()[0])
+        self.boot_time = self.now - self.uptime
+        for line in read_file(join(proc, 'stat')).splitlines():
+            if line.startswith(b'btime '):
+                self.boot_time = int(line.split()[1])
+                break
+        self.mem_total = 0
+        for line in read_file(join(proc, 'meminfo')).splitlines():
+            if line.startswith(b'MemTotal:'):
+                self.mem_total = int(line.split()[1])
+                break
+        self.user_names = dict()
+
+    def user_name(self, uid):
+        name = self.user_names.get(uid)
+        if name is None:
+            try:
+                name = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                name = str(uid)
+            self.user_names[uid] = name
+        return name
+
+    def tty_name(self, tty_nr):
+        if tty_nr == 0:
+            return '?'
+        major = os.major(tty_nr)
+        minor = os.minor(tty_nr)
+        if 136 <= major <= 143:
+            return 'pts/%d' % ((major - 136) * 256 + minor)
+        if major == 4:
+            return 'tty%d' % minor if minor < 64 else 'ttyS%d' % (minor - 64)
+        return '?'
+
+    def start_time(self, starttime):
+        started = self.boot_time + float(starttime) / self.hz
+        age = self.now - started
+        if age > 365 * 86400:
+            return time.strftime('%Y', time.localtime(started))
+        if age > 86400:
+            return time.strftime('%b%d', time.localtime(started))
+        return time.strftime('%H:%M', time.localtime(started))
+
+    def read_process(self, pid, kernel_threads=True):
+        # raises IOError/OSError when the process exited meanwhile, returns
+        # None for a kernel thread unless kernel_threads
+        path = '%s/%s/' % (self.proc, pid)
+        stat = read_file(path + 'stat')
+        # the command name is in parenthesis and may contain both spaces
+        # and parenthesis
+        end = stat.rindex(b')')
+        comm = stat[stat.index(b'(') + 1:end].decode('utf-8', 'replace')
+        fields = stat[end + 2:].split()
+        if not kernel_threads and int(fields[6]) & PF_KTHREAD:
+            return None
+        state = fields[0].decode('ascii')
+        ppid = fields[1].decode('ascii')
+        pgrp = int(fields[2])
+        session = int(fields[3])
+        tty_nr = int(fields[4])
+        tpgid = int(fields[5])
+        cpu_ticks = int(fields[11]) + int(fields[12])
+        nice = int(fields[16])
+        threads = int(fields[17])
+        starttime = int(fields[19])
+
+        # the effective user, and the exact memory sizes, are only in status
+        status = read_file(path + 'status')
+        start = status.index(b'\nUid:') + 5
+        uid = int(status[start:status.index(b'\n', start)].split()[1])
+        sizes = dict(STATUS_SIZES.findall(status))
+        vsz = int(sizes.get(b'VmSize', int(fields[20]) // 1024))
+        rss = int(sizes.get(b'VmRSS', int(fields[21]) * self.page_kb))
+        locked = int(sizes.get(b'VmLck', 0)) > 0
+
+        command = read_file(path + 'cmdline').rstrip(b'\0').replace(b'\0', b' ')
+        command = command.decode('utf-8', 'replace').replace('\n', ' ').replace('\t', ' ')
+        if not command:
+            command = '[%s]' % comm
+            if state == 'Z':
+                command += ' <defunct>'
+
+        # ps reports lifetime cpu usage and memory usage in tenths of a
+        # percent, truncated
+        elapsed = self.uptime - float(starttime) / self.hz
+        pcpu = int(cpu_ticks * 1000 // self.hz / elapsed) if elapsed > 0 else 0
+        pmem = rss * 1000 // self.mem_total if self.mem_total else 0
+        cpu_seconds = cpu_ticks // self.hz
+
+        flags = state
+        if nice < 0:
+            flags += '<'
+        elif nice > 0:
+            flags += 'N'
+        if locked:
+            flags += 'L'
+        if session == int(pid):
+            flags += 's'
+        if threads > 1:
+            flags += 'l'
+        if tpgid == pgrp:
+            flags += '+'
+
+        return dict(
+            user=self.user_name(uid),
+            pid=pid,
+            ppid=ppid,
+            cpu_percentage='%d.%d' % (pcpu // 10, pcpu % 10),
+            memory_percentage='%d.%d' % (pmem // 10, pmem % 10),
+            virtual_memory_size=str(vsz),
+            resident_size=str(rss),
+            teletype=self.tty_name(tty_nr),
+            stat=flags,
+            start=self.start_time(starttime),
+            time='%d:%02d' % (cpu_seconds // 60, cpu_seconds % 60),
+            command=command
+        )
+
+    def processes(self, keep=None, kernel_threads=True):
+        # Returns the processes keep (a function, see process_filter) is
+        # True for, and the number of running processes
+        processes = list()
+        total = 0
+        for pid in sorted((p for p in os.listdir(self.proc) if p.isdigit()), key=int):
+            try:
+                process = self.read_process(pid, kernel_threads)
+            except (IOError, OSError, ValueError, IndexError):
+                # exited while being read
+                continue
+            total += 1
+            if process is not None and (keep is None or keep(process)):
+                processes.append(process)
+        return processes, total
+
+
+class ProcSampler(object):
+    # Samples the cpu ticks of every process from /proc/<pid>/stat alone,
+    # samples times over window seconds, to report the cpu usage of every
+    # process during the window instead of its lifetime average.  Every
+    # process is read in full once, by the sample it is first seen in, so
+    # the ones that exit before the end of the window are still reported and
+    # the result is built from the samples without reading /proc again.
+    # Samples are spaced so the cpu time the sampler uses, full reads
+    # included, stays below cpu_budget percent of the time elapsed, samples
+    # that would not fit in the window are dropped.
+    def __init__(self, samples, window, cpu_budget, proc='/proc'):
+        self.samples = samples
+        self.window = window
+        self.cpu_budget = cpu_budget
+        self.proc = proc
+        self.hz = os.sysconf('SC_CLK_TCK')
+        self.first = dict()
+        self.last = dict()
+        # (pid, starttime) -> process read in full, None when not kept
+        self.read = dict()
+        self.appeared = set()
+        self.taken = 0
+        self.cpu_seconds = 0.0
+        self.elapsed = 0.0
+
+    def ticks(self):
+        # (pid, starttime) -> cpu ticks of every running process
+        snapshot = dict()
+        for pid in os.listdir(self.proc):
+            if not pid.isdigit():
+                continue
+            try:
+                stat = read_file('%s/%s/stat' % (self.proc, pid))
+                fields = stat[stat.rindex(b')') + 2:].split()
+                snapshot[(pid, fields[19])] = int(fields[11]) + int(fields[12])
+            except (IOError, OSError, ValueError, IndexError):
+                continue
+        return snapshot
+
+    def sample(self, keep=None, kernel_threads=True):
+        now = time.time()
+        snapshot = self.ticks()
+        reader = None
+        for key, ticks in snapshot.items():
+            if key not in self.first:
+                self.first[key] = (now, ticks)
+                if reader is None:
+                    reader = ProcReader(self.proc)
+                self.read_process(reader, key, keep, kernel_threads)
+                if self.taken > 0:
+                    # appeared since the previous sample
+                    self.appeared.add(key)
+            self.last[key] = (now, ticks)
+        self.taken += 1
+        return snapshot
+
+    def read_process(self, reader, key, keep=None, kernel_threads=True):
+        try:
+            process = reader.read_process(key[0], kernel_threads)
+        except (IOError, OSError, ValueError, IndexError):
+            # exited meanwhile, read again at the end of the window if it
+            # is still running
+            return
+        self.read[key] = process if process is not None and (keep is None or keep(process)) else None
+
+    def cpu_percentage(self, key):
+        # cpu usage between the first and the last sample the process was
+        # seen in, None when it was seen in a single one
+        first_time, first_ticks = self.first[key]
+        last_time, last_ticks = self.last[key]
+        if last_time <= first_time:
+            return None
+        return '%.1f' % ((last_ticks - first_ticks) * 100.0 / self.hz / (last_time - first_time))
+
+    def processes(self, keep=None, kernel_threads=True):
+        # Returns the processes running at the last sample, the processes
+        # that appeared and exited during the window, and the number of
+        # processes running at the last sample
+        start = time.time()
+        start_cpu = sum(os.times()[:2])
+        interval = float(self.window) / (self.samples - 1)
+        snapshot = self.sample(keep, kernel_threads)
+        for i in range(1, self.samples):
+            cpu = sum(os.times()[:2]) - start_cpu
+            due = max(start + i * interval, start + cpu * 100.0 / self.cpu_budget)
+            if due > start + self.window + interval / 2:
+                break
+            time.sleep(max(0, due - time.time()))
+            snapshot = self.sample(keep, kernel_threads)
+
+        # only the processes of the last sample that could not be read when
+        # first seen are read again
+        reader = None
+        for key in snapshot:
+            if key not in self.read:
+                if reader is None:
+                    reader = ProcReader(self.proc)
+                self.read_process(reader, key, keep, kernel_threads)
+        processes = list()
+        transient = list()
+        for key in sorted(self.read, key=lambda k: int(k[0])):
+            p = self.read[key]
+            if p is None or (key not in snapshot and key not in self.appeared):
+                continue
+            cpu = self.cpu_percentage(key)
+            if cpu is not None:
+                p['sampled_cpu_percentage'] = cpu
+            if key in snapshot:
+                processes.append(p)
+            else:
+                transient.append(p)
+        self.elapsed = time.time() - start
+        self.cpu_seconds = sum(os.times()[:2]) - start_cpu
+        return processes, transient, len(snapshot)
+
+
+def parse_ps_lines(lines, parse=True, stdout_lines=None, keep=None):
+    # Parses 'ps auxww' output as it is read from any iterable of lines (i.e.
+    # the pipe from ps), with a single match per line.  The lines are kept
+    # in stdout_lines when it is given.  With keep (see process_filter),
+    # only the processes and lines it is True for are kept.  Returns the
+    # parsed processes and the number of process lines.
+    match = RE_PS.match
+    processes = list()
+    count = 0
+    for line in lines:
+        if not isinstance(line, str):
+            line = line.decode('utf-8', 'replace')
+        line = line.rstrip('\n')
+        if not line or line.startswith('USER'):
+            continue
+        line = line.replace('\t', '    ')
+        count += 1
+        if keep is not None:
+            m = match(line)
+            if m is None or not keep(m.groupdict()):
+                continue
+        if stdout_lines is not None:
+            stdout_lines.append(line)
+        if parse:
+            m = match(line) if keep is None else m
+            if m is not None:
+                processes.append(m.groupdict())
+    return processes, count
+
+
+PROCESS_FIELDS = ['user', 'pid', 'ppid', 'cpu_percentage', 'memory_percentage', 'virtual_memory_size', 'resident_size',
+                  'teletype', 'stat', 'start', 'time', 'command']
+INTERNED_FIELDS = ['user', 'teletype', 'stat', 'start']
+
+
+def process_children(processes):
+    # parent pid -> pids of its children
+    children = dict()
+    for p in processes:
+        if p.get('ppid') is not None:
+            children.setdefault(p['ppid'], list()).append(p['pid'])
+    return children
+
+
+def collapse_workers(processes):
+    # Identical children of a parent (same user and command) are returned
+    # as the first of them, holding the number of workers and their total
+    # resident size and cpu and memory percentages
+    groups = dict()
+    for p in processes:
+        if p.get('ppid') not in (None, '0'):
+            groups.setdefault((p['ppid'], p['user'], p['command']), list()).append(p)
+    collapsed = list()
+    for p in processes:
+        workers = groups.get((p.get('ppid'), p['user'], p['command']))
+        if workers is None or len(workers) < 2:
+            collapsed.append(p)
+        elif workers[0] is p:
+            p = dict(p)
+            p['workers'] = len(workers)
+            p['resident_size'] = str(sum(int(w['resident_size']) for w in workers))
+            p['cpu_percentage'] = '%.1f' % sum(float(w['cpu_percentage']) for w in workers)
+            p['memory_percentage'] = '%.1f' % sum(float(w['memory_percentage']) for w in workers)
+            collapsed.append(p)
+    return collapsed
+
+
+# fields converted by typed_fields, with their type and the factor bringing
+# them to bytes
+NUMERIC_FIELDS = [('pid', int, 1), ('ppid', int, 1), ('cpu_percentage', float, 1), ('memory_percentage', float, 1),
+                  ('sampled_cpu_percentage', float, 1), ('virtual_memory_size', int, 1024),
+                  ('resident_size', int, 1024)]
+
+
+def type_fields(processes):
+    # converts the numeric fields of processes in place
+    for p in processes:
+        for field, kind, factor in NUMERIC_FIELDS:
+            v = p.get(field)
+            if v is not None:
+                p[field] = kind(v) * factor
+    return processes
+
+
+def to_columns(processes):
+    # One list per field instead of one dictionary per process, a field a
+    # process does not have is None.  Interned fields hold indexes into the
+    # list of their distinct values.
+    fields = list(PROCESS_FIELDS)
+    for p in processes:
+        for f in p:
+            if f not in fields:
+                fields.append(f)
+    columns = dict((f, list()) for f in fields)
+    values = dict((f, list()) for f in INTERNED_FIELDS)
+    interned = dict((f, dict()) for f in INTERNED_FIELDS)
+    for p in processes:
+        for f in fields:
+            v = p.get(f)
+            if f in interned:
+                i = interned[f].get(v)
+                if i is None:
+                    i = interned[f][v] = len(values[f])
+                    values[f].append(v)
+                v = i
+            columns[f].append(v)
+    return columns, values
+
+
+def parse_ppids(lines):
+    # pid -> parent pid, from the output of 'ps -e -o pid= -o ppid='
+    ppids = dict()
+    for line in lines:
+        if not isinstance(line, str):
+            line = line.decode('utf-8', 'replace')
+        fields = line.split()
+        if len(fields) == 2:
+            ppids[fields[0]] = fields[1]
+    return ppids
+
+
+def ps_line(process):
+    return PS_LINE % (process['user'], process['pid'], process['cpu_percentage'], process['memory_percentage'],
+                      process['virtual_memory_size'], process['resident_size'], process['teletype'],
+                      process['stat'], process['start'], process['time'], process['command'])
+
+
 def main():
     module_args = dict(
         output_ps_stdout_lines=dict(
@@ -81,6 +692,88 @@ def main():
             type='bool',
             default=True,
             required=False
+        ),
+        backend=dict(
+            type='str',
+            default='auto',
+            choices=['auto', 'proc', 'ps'],
+            required=False
+        ),
+        output_format=dict(
+            type='str',
+            default='rows',
+            choices=['rows', 'columns'],
+            required=False
+        ),
+        include_commands=dict(
+            type='list',
+            default=list(),
+            required=False
+        ),
+        exclude_commands=dict(
+            type='list',
+            default=list(),
+            required=False
+        ),
+        users=dict(
+            type='list',
+            default=list(),
+            required=False
+        ),
+        min_rss=dict(
+            type='int',
+            default=0,
+            required=False
+        ),
+        min_cpu=dict(
+            type='float',
+            default=0,
+            required=False
+        ),
+        drop_kernel_threads=dict(
+            type='bool',
+            default=False,
+            required=False
+        ),
+        process_tree=dict(
+            type='bool',
+            default=False,
+            required=False
+        ),
+        collapse_workers=dict(
+            type='bool',
+            default=False,
+            required=False
+        ),
+        samples=dict(
+            type='int',
+            default=1,
+            required=False
+        ),
+        sample_window=dict(
+            type='float',
+            default=10,
+            required=False
+        ),
+        sample_cpu_budget=dict(
+            type='float',
+            default=5,
+            required=False
+        ),
+        typed_fields=dict(
+            type='bool',
+            default=False,
+            required=False
+        ),
+        listening_ports=dict(
+            type='bool',
+            default=False,
+            required=False
+        ),
+        max_fds=dict(
+            type='int',
+            default=4096,
+            required=False
         )
     )
 
@@ -96,46 +789,65 @@ def main():
     )
 
     params = module.params
+    try:
+        keep = process_filter(params)
+    except re.error as e:
+        module.fail_json(msg="Invalid %s" % e)
 
-    def get_processes():
-        re_header = re.compile(r'^USER+.*')
-        proc_stats = dict()
-        procs = list()
-        count = 0
-        running = subprocess.check_output(["ps auxww"], universal_newlines=True, shell=True)
-        for l in running.split('\n'):
-            if len(l) > 0 and re_header.search(l) is None:
-                procs.append(l.replace('\n', '').replace('\t', '    '))
-                count += 1
-        proc_stats['stdout'] = procs
-        proc_stats['total_running_processes'] = count
+    def get_processes(parse):
+        # streams the output of ps into the parser, so only the parsed
+        # processes are ever held in memory
+        proc_stats = dict(stdout=list() if params['output_ps_stdout_lines'] else None)
+        try:
+            ps = subprocess.Popen([module.get_bin_path('ps', required=True), 'auxww'], stdout=subprocess.PIPE)
+        except (IOError, OSError) as e:
+            module.fail_json(msg="Unable to run ps: %s" % e)
+        try:
+            proc_stats['processes'], proc_stats['total_running_processes'] = \
+                parse_ps_lines(ps.stdout, parse, proc_stats['stdout'], keep)
+        finally:
+            ps.stdout.close()
+            rc = ps.wait()
+        if rc != 0:
+            module.fail_json(msg="ps auxww failed with return code %d" % rc)
         return proc_stats
 
-    def parse_process_data(procs):
-        re_ps = re.compile(r'^(?P<user>[\w\+\-\_\$\d]+)\s+(?P<pid>[0-9]+)\s+(?P<cpu>[0-9\.]+)\s+(?P<mem>[0-9\.]+)\s+(?P<vsz>[0-9]+)\s+(?P<rss>[0-9]+)\s+(?P<tty>[a-zA-Z0-9\?\/\-]+)\s+(?P<stat>[ADIRSTtWXZ\<NLsl\+]+)\s+(?P<start>[\w\:\d]+\s?[\d]{2})\s+(?P<time>[0-9\:]+)\s+(?P<command>.*)$')
-        processes = list()
-
-        for proc in procs:
-            process = dict()
-            if re_ps.search(proc):
-                process['user'] = re_ps.search(proc).group('user')
-                process['pid'] = re_ps.search(proc).group('pid')
-                process['cpu_percentage'] = re_ps.search(proc).group('cpu')
-                process['memory_percentage'] = re_ps.search(proc).group('mem')
-                process['virtual_memory_size'] = re_ps.search(proc).group('vsz')
-                process['resident_size'] = re_ps.search(proc).group('rss')
-                process['teletype'] = re_ps.search(proc).group('tty')
-                process['stat'] = re_ps.search(proc).group('stat')
-                process['start'] = re_ps.search(proc).group('start')
-                process['time'] = re_ps.search(proc).group('time')
-                process['command'] = re_ps.search(proc).group('command')
-                processes.append(process)
-        return processes
+    def get_ppids():
+        # 'ps auxww' has no parent pid
+        rc, out, err = module.run_command([module.get_bin_path('ps', required=True), '-e', '-o', 'pid=', '-o', 'ppid='])
+        if rc != 0:
+            module.fail_json(msg="ps -e -o pid= -o ppid= failed with return code %d: %s" % (rc, err))
+        return parse_ppids(out.splitlines())
 
     # Do work
-    raw_procs = get_processes()
-    if params['output_parsed_processes']:
-        proc_data = parse_process_data(raw_procs['stdout'])
+    backend = params['backend']
+    if backend == 'auto':
+        backend = 'proc' if sys.platform.startswith('linux') and isfile('/proc/self/stat') else 'ps'
+    sampler = None
+    if params['samples'] > 1:
+        if backend != 'proc':
+            module.fail_json(msg="samples requires the proc backend")
+        if params['sample_window'] <= 0 or params['sample_cpu_budget'] <= 0:
+            module.fail_json(msg="sample_window and sample_cpu_budget must be greater than 0")
+        sampler = ProcSampler(params['samples'], params['sample_window'], params['sample_cpu_budget'])
+    if backend == 'proc':
+        try:
+            if sampler is not None:
+                proc_data, transient, total = sampler.processes(keep, not params['drop_kernel_threads'])
+            else:
+                proc_data, total = ProcReader().processes(keep, not params['drop_kernel_threads'])
+        except (IOError, OSError) as e:
+            module.fail_json(msg="Unable to read processes from /proc: %s" % e)
+        raw_procs = dict(stdout=list(), total_running_processes=total)
+        if params['output_ps_stdout_lines']:
+            raw_procs['stdout'] = [ps_line(p) for p in proc_data]
+    else:
+        raw_procs = get_processes(params['output_parsed_processes'])
+        proc_data = raw_procs['processes']
+        if proc_data:
+            ppids = get_ppids()
+            for p in proc_data:
+                p['ppid'] = ppids.get(p['pid'])
 
     # Build output
     processes = dict()
@@ -143,8 +855,36 @@ def main():
         processes['ps_stdout_lines'] = raw_procs['stdout']
     if params['output_parsed_processes']:
         processes['total_running_processes'] = raw_procs['total_running_processes']
-        processes['processes'] = proc_data
-    result = {'ansible_facts': {'running_processes': processes}}
+        if params['listening_ports']:
+            if not isdir('/proc/net'):
+                module.fail_json(msg="listening_ports requires /proc")
+            sockets = SocketIndex(max_fds=params['max_fds'])
+            processes['listeners'] = sockets.join(proc_data)
+            if sockets.skipped:
+                module.warn("%d processes with more than %d open files were not searched for listening sockets" %
+                            (sockets.skipped, params['max_fds']))
+        if params['process_tree']:
+            processes['children'] = process_children(proc_data)
+        if params['collapse_workers']:
+            proc_data = collapse_workers(proc_data)
+        if params['typed_fields']:
+            type_fields(proc_data)
+            if sampler is not None:
+                type_fields(transient)
+            for children in processes.get('children', dict()).values():
+                children[:] = [int(c) for c in children]
+            for listener in processes.get('listeners', list()):
+                listener['pids'] = [int(pid) for pid in listener['pids']]
+        if params['output_format'] == 'columns':
+            processes['columns'], processes['values'] = to_columns(proc_data)
+        else:
+            processes['processes'] = proc_data
+        if sampler is not None:
+            processes['transient_processes'] = transient
+    result = {'ansible_facts': {'running_processes': processes}, 'backend': backend}
+    if sampler is not None:
+        result['sampling'] = dict(samples=sampler.taken, window=round(sampler.elapsed, 3),
+                                  cpu_seconds=round(sampler.cpu_seconds, 3))
 
     module.exit_json(**result)
 